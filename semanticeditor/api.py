@@ -1,8 +1,10 @@
 # This module contains the 'public' API for parsing/formatting HTML,
 # used by views.py
 
+from semanticeditor.batch import batch_extract_presentation, batch_format_html, batch_reformat_html, BatchResult
+from semanticeditor.caching import format_html_cached
 from semanticeditor.clean import clean_html
-from semanticeditor.definitions import AllUserErrors, COMMANDS, PresentationInfo, PresentationClass
+from semanticeditor.definitions import AllUserErrors, COMMANDS, PresentationInfo, PresentationClass, get_presentation_info
 from semanticeditor.extract import extract_presentation, extract_structure
 from semanticeditor.format import format_html, preview_html
 from semanticeditor.models import get_classes
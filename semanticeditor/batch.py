@@ -0,0 +1,199 @@
+"""
+Batch versions of format_html and extract_presentation, for processing large
+numbers of documents, e.g. all stored content after CSS classes have changed.
+
+Documents are processed in a pool of worker processes, which is kept alive
+between batches (see SEMANTICEDITOR_BATCH_PROCESSES and
+SEMANTICEDITOR_BATCH_CHUNKSIZE).  With 1 process or less, documents are
+processed in the calling process.
+"""
+import atexit
+import cPickle
+import multiprocessing
+import threading
+
+from django.conf import settings
+
+from semanticeditor.definitions import AllUserErrors
+from semanticeditor.extract import extract_presentation
+from semanticeditor.format import format_html
+from semanticeditor.utils.datastructures import struct
+
+
+class BatchResult(object):
+    __metaclass__ = struct
+    index = 0     # index is the position of the document in the input
+    value = None  # value is the return value, or None if there was an error
+    error = None  # error is the user error (see AllUserErrors) raised, if any
+
+
+def batch_format_html(items, pretty_print=False, processes=None, chunksize=None, ordered=True):
+    """
+    Calls format_html for each (html, styleinfo) pair in the iterable 'items',
+    and yields a BatchResult for each one.  If ordered is False, results are
+    yielded as soon as they are ready, rather than in input order.
+    """
+    return _run_batch(_format_one, ((html, styleinfo, pretty_print)
+                                    for html, styleinfo in items),
+                      processes, chunksize, ordered)
+
+
+def batch_extract_presentation(docs, processes=None, chunksize=None, ordered=True):
+    """
+    Calls extract_presentation for each HTML document in the iterable 'docs',
+    and yields a BatchResult for each one.  If ordered is False, results are
+    yielded as soon as they are ready, rather than in input order.
+    """
+    return _run_batch(_extract_one, ((html,) for html in docs),
+                      processes, chunksize, ordered)
+
+
+def batch_reformat_html(docs, classes, pretty_print=True, processes=None, chunksize=None, ordered=True):
+    """
+    Extracts presentation info from each HTML document in the iterable 'docs'
+    and formats it again, yielding a BatchResult containing the new HTML for
+    each one.  'classes' is a dictionary of PresentationClass objects keyed on
+    name, which are used in place of the extracted classes, so that
+    column_equiv etc. are up to date.  Classes not in 'classes' are removed.
+    """
+    # 'classes' is the same for every document, so it is sent to each worker
+    # once, rather than with every job.
+    return _run_batch(_reformat_one, ((html, pretty_print) for html in docs),
+                      processes, chunksize, ordered,
+                      initializer=_init_reformat, initargs=(classes,))
+
+
+def close_pool():
+    """
+    Shuts down the worker processes used for batch processing, if running.
+    """
+    global _pool, _pool_key, _pool_users
+    with _pool_lock:
+        if _pool is not None:
+            _pool.terminate()
+            _pool.join()
+            _pool = None
+            _pool_key = None
+            _pool_users = 0
+
+atexit.register(close_pool)
+
+
+### Implementation ###
+
+_pool = None
+_pool_key = None
+_pool_users = 0
+_pool_lock = threading.Lock()
+
+
+def _acquire_pool(processes, initializer=None, initargs=()):
+    # The shared pool is reused for as long as the same initializer and
+    # arguments are asked for, so that a run of batches with the same
+    # 'classes' only starts the workers and sends the arguments to them once.
+    # If a batch still using the shared pool needs different arguments, a
+    # pool of its own is started for the new batch instead.
+    # The arguments are compared in the form sent to the workers, because
+    # PresentationInfo objects compare equal if only their names are the same,
+    # and the workers need to be started again if e.g. column_equiv changes.
+    global _pool, _pool_key, _pool_users
+    key = (processes, initializer, cPickle.dumps(initargs, cPickle.HIGHEST_PROTOCOL))
+    with _pool_lock:
+        if _pool is not None and _pool_key != key:
+            if _pool_users > 0:
+                return multiprocessing.Pool(processes, initializer, initargs)
+            _pool.terminate()
+            _pool.join()
+            _pool = None
+        if _pool is None:
+            _pool = multiprocessing.Pool(processes, initializer, initargs)
+            _pool_key = key
+        _pool_users += 1
+        return _pool
+
+
+def _release_pool(pool):
+    global _pool_users
+    with _pool_lock:
+        if pool is _pool:
+            _pool_users -= 1
+            return
+    pool.terminate()
+    pool.join()
+
+
+def _run_in_process(func, jobs, initializer, initargs):
+    for job in jobs:
+        # Done for each job, in case batches with different arguments are
+        # interleaved.
+        if initializer is not None:
+            initializer(*initargs)
+        yield func(job)
+
+
+def _run_batch(func, args_iter, processes, chunksize, ordered, initializer=None, initargs=()):
+    if processes is None:
+        processes = getattr(settings, 'SEMANTICEDITOR_BATCH_PROCESSES', None)
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+    if chunksize is None:
+        chunksize = getattr(settings, 'SEMANTICEDITOR_BATCH_CHUNKSIZE', 10)
+
+    jobs = enumerate(args_iter)
+    if processes <= 1:
+        for index, value, error in _run_in_process(func, jobs, initializer, initargs):
+            yield BatchResult(index=index, value=value, error=error)
+        return
+
+    pool = _acquire_pool(processes, initializer, initargs)
+    try:
+        if ordered:
+            results = pool.imap(func, jobs, chunksize)
+        else:
+            results = pool.imap_unordered(func, jobs, chunksize)
+        for index, value, error in results:
+            yield BatchResult(index=index, value=value, error=error)
+    finally:
+        _release_pool(pool)
+
+
+# These are run in the worker processes, and return (index, value, error)
+# tuples, so that user errors don't stop the batch.  Other exceptions are
+# re-raised in the calling process.
+
+def _format_one(job):
+    index, (html, styleinfo, pretty_print) = job
+    try:
+        return (index, format_html(html, styleinfo, pretty_print=pretty_print), None)
+    except AllUserErrors, e:
+        return (index, None, e)
+
+
+def _extract_one(job):
+    index, (html,) = job
+    try:
+        return (index, extract_presentation(html), None)
+    except AllUserErrors, e:
+        return (index, None, e)
+
+
+_reformat_classes = None
+
+def _init_reformat(classes):
+    global _reformat_classes
+    _reformat_classes = classes
+
+
+def _reformat_one(job):
+    index, (html, pretty_print) = job
+    classes = _reformat_classes
+    try:
+        pres, simple_html = extract_presentation(html)
+        styleinfo = {}
+        for sect_id, presinfos in pres.items():
+            styleinfo[sect_id] = [pi if pi.prestype == 'command' else classes[pi.name]
+                                  for pi in presinfos
+                                  if pi.prestype == 'command' or pi.name in classes]
+        return (index, format_html(simple_html, styleinfo, pretty_print=pretty_print), None)
+    except AllUserErrors, e:
+        return (index, None, e)
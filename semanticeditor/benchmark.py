@@ -0,0 +1,250 @@
+"""
+Benchmarks for the HTML processing pipeline, using generated documents.
+
+run_benchmarks() times each stage of the pipeline separately for a set of
+documents, and returns results that can be saved as JSON, and compared with a
+saved baseline using find_regressions().  See also the 'semanticeditor_benchmark'
+management command.
+"""
+import platform
+import random
+import sys
+import time
+
+from semanticeditor.clean import clean_tree
+from semanticeditor.common import parse, get_structure
+from semanticeditor.definitions import PresentationClass, NEWROW, NEWCOL, NEWINNERROW, NEWINNERCOL
+from semanticeditor.extract import extract_presentation
+from semanticeditor.format import format_html, preview_html
+from semanticeditor.layout import create_layout
+
+
+# Named document configurations, passed as keyword arguments to
+# generate_document.
+DOCUMENTS = {
+    'small': dict(sections=5),
+    'medium': dict(sections=50),
+    'large': dict(sections=300, heading_depth=4, list_depth=3),
+    'pasted': dict(sections=50, junk=0.8),
+    'flat': dict(sections=50, layout=False),
+}
+
+STAGES = ['parse', 'clean_tree', 'get_structure', 'create_layout',
+          'format_html', 'extract_presentation', 'preview_html']
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+         "tempor incididunt ut labore et dolore magna aliqua enim ad minim veniam "
+         "quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo "
+         "consequat").split()
+
+CLASSES = ['important', 'highlight', 'box', 'quote', 'wide']
+
+
+def generate_document(seed=0, sections=20, heading_depth=3, list_depth=2,
+                      junk=0.0, layout=True):
+    """
+    Generates a document, returning a tuple of simple HTML and a style info
+    dictionary that can be passed to format_html.  The same arguments always
+    produce the same document.
+
+    sections is the number of headings, heading_depth is the deepest heading
+    level used, list_depth is the maximum nesting of lists.  junk is the
+    proportion of paragraphs that contain the kind of markup produced by
+    pasting from a word processor. If layout is True, row and column commands
+    are added to the style info.
+    """
+    return _DocumentGenerator(random.Random(seed), heading_depth, list_depth,
+                              junk, layout).generate(sections)
+
+
+def run_benchmarks(documents=None, repeat=5, seed=0):
+    """
+    Times each stage of the pipeline for the named documents (see DOCUMENTS,
+    defaults to all of them), and returns a dictionary suitable for saving as
+    JSON.  Each stage is run 'repeat' times, and the minimum and median times
+    (in seconds) are recorded, along with the size of each document.
+    """
+    if documents is None:
+        documents = sorted(DOCUMENTS.keys())
+    results = {}
+    for name in documents:
+        html, styleinfo = generate_document(seed=seed, **DOCUMENTS[name])
+        times = time_stages(html, styleinfo, repeat)
+        results[name] = dict(size=len(html),
+                             stages=dict((stage, _summarise(t)) for stage, t in times.items()))
+    return dict(meta=dict(python=sys.version.split()[0],
+                          platform=platform.platform(),
+                          repeat=repeat,
+                          seed=seed,
+                          time=time.strftime("%Y-%m-%dT%H:%M:%S")),
+                results=results)
+
+
+def time_stages(html, styleinfo, repeat=5):
+    """
+    Returns a dictionary of stage name: list of times for each stage in STAGES.
+    """
+    times = dict((stage, []) for stage in STAGES)
+    rendered = format_html(html, styleinfo)
+    for i in range(repeat):
+        start = time.time()
+        root = parse(html)
+        times['parse'].append(time.time() - start)
+
+        start = time.time()
+        clean_tree(root)
+        times['clean_tree'].append(time.time() - start)
+
+        start = time.time()
+        structure = get_structure(root, assert_structure=True)
+        times['get_structure'].append(time.time() - start)
+
+        start = time.time()
+        create_layout(root, styleinfo, structure)
+        times['create_layout'].append(time.time() - start)
+
+        for stage, func, args in [('format_html', format_html, (html, styleinfo)),
+                                  ('extract_presentation', extract_presentation, (rendered,)),
+                                  ('preview_html', preview_html, (html, styleinfo))]:
+            start = time.time()
+            func(*args)
+            times[stage].append(time.time() - start)
+    return times
+
+
+def find_regressions(results, baseline, threshold=0.2):
+    """
+    Compares results from run_benchmarks with a baseline from a previous run,
+    returning a list of (document, stage, baseline time, new time) for each
+    stage that is more than 'threshold' (a fraction) slower.  Minimum times
+    are compared, as they are least affected by other activity.
+    """
+    regressions = []
+    for name, doc_results in sorted(results['results'].items()):
+        if name not in baseline['results']:
+            continue
+        stages = doc_results['stages']
+        old_stages = baseline['results'][name]['stages']
+        for stage in STAGES:
+            if stage not in stages or stage not in old_stages:
+                continue
+            old = old_stages[stage]['min']
+            new = stages[stage]['min']
+            if new > old * (1 + threshold):
+                regressions.append((name, stage, old, new))
+    return regressions
+
+
+def _summarise(times):
+    times = sorted(times)
+    return dict(min=times[0], median=times[len(times) // 2])
+
+
+class _DocumentGenerator(object):
+
+    def __init__(self, rand, heading_depth, list_depth, junk, layout):
+        self.rand = rand
+        self.heading_depth = heading_depth
+        self.list_depth = list_depth
+        self.junk = junk
+        self.layout = layout
+
+    def generate(self, sections):
+        # Top level blocks are given explicit ids, so that style info can
+        # refer to them.
+        blocks = []
+        level = 0
+        for i in range(sections):
+            level = self.rand.randint(1, min(level + 1, self.heading_depth))
+            blocks.append(('h%d' % level, self.words(2, 6)))
+            for j in range(self.rand.randint(1, 4)):
+                kind = self.rand.random()
+                if kind < 0.6:
+                    blocks.append(('p', self.inline()))
+                elif kind < 0.85:
+                    blocks.append((self.rand.choice(['ul', 'ol']), self.list_items(1)))
+                else:
+                    blocks.append(('blockquote', '<p>%s</p>' % self.inline()))
+
+        html = []
+        styleinfo = {}
+        sect_ids = []
+        for i, (tag, content) in enumerate(blocks):
+            sect_id = "%s_s%d" % (tag, i)
+            sect_ids.append(sect_id)
+            html.append('<%s id="%s">%s</%s>' % (tag, sect_id, content, tag))
+            if self.rand.random() < 0.2:
+                styleinfo[sect_id] = [PresentationClass(self.rand.choice(CLASSES))]
+        if self.layout:
+            self.add_layout(sect_ids, styleinfo)
+        return (u"\n".join(html), styleinfo)
+
+    def words(self, least, most):
+        return " ".join(self.rand.choice(WORDS) for i in range(self.rand.randint(least, most)))
+
+    def inline(self):
+        parts = []
+        for i in range(self.rand.randint(1, 5)):
+            text = self.words(3, 15)
+            kind = self.rand.random()
+            if kind < 0.15:
+                text = '<strong>%s</strong>' % text
+            elif kind < 0.3:
+                text = '<em>%s</em>' % text
+            elif kind < 0.4:
+                text = '<a href="http://example.com/%d">%s</a>' % (i, text)
+            parts.append(text)
+        html = " ".join(parts)
+        if self.rand.random() < self.junk:
+            html = self.add_junk(html)
+        return html
+
+    def add_junk(self, html):
+        kind = self.rand.randint(0, 3)
+        if kind == 0:
+            return ('<span style="font-size: 11pt; font-family: Calibri">%s</span>'
+                    '<o:p></o:p>' % html)
+        elif kind == 1:
+            return '<font face="Arial"><b>%s</b></font>' % html
+        elif kind == 2:
+            return '<span class="MsoNormal"><i>%s</i><br /><br /></span>' % html
+        else:
+            return '<span style="mso-bidi-font-weight: bold"><style>p {}</style>%s</span>' % html
+
+    def list_items(self, depth):
+        items = []
+        for i in range(self.rand.randint(1, 5)):
+            item = self.inline()
+            if depth < self.list_depth and self.rand.random() < 0.3:
+                tag = self.rand.choice(['ul', 'ol'])
+                item += '<%s>%s</%s>' % (tag, self.list_items(depth + 1), tag)
+            items.append('<li>%s</li>' % item)
+        return "".join(items)
+
+    def add_layout(self, sect_ids, styleinfo):
+        # Split blocks into rows, and rows into columns, with some columns
+        # containing inner rows.
+        i = 0
+        while i < len(sect_ids):
+            row_len = self.rand.randint(2, 8)
+            row = sect_ids[i:i + row_len]
+            i += row_len
+            if self.rand.random() < 0.3:
+                # A row with a single column, which needs no commands
+                continue
+            self.add_command(styleinfo, NEWROW, row[0])
+            num_cols = self.rand.randint(1, min(4, len(row)))
+            col_len = len(row) // num_cols
+            for c in range(num_cols):
+                col = row[c * col_len:(c + 1) * col_len if c < num_cols - 1 else len(row)]
+                self.add_command(styleinfo, NEWCOL, col[0])
+                if len(col) >= 3 and self.rand.random() < 0.3:
+                    self.add_command(styleinfo, NEWINNERROW, col[1])
+                    self.add_command(styleinfo, NEWINNERCOL, col[1])
+                    self.add_command(styleinfo, NEWINNERCOL, col[2])
+
+    def add_command(self, styleinfo, command, sect_id):
+        presinfo = [command]
+        if self.rand.random() < 0.2:
+            presinfo.append(PresentationClass(self.rand.choice(CLASSES)))
+        styleinfo[command.prefix + sect_id] = presinfo
@@ -0,0 +1,236 @@
+"""
+Optional caching of formatted HTML, using Django's cache framework so that
+cached results can be shared between processes and servers, and the
+'round-trip' fast path, which avoids formatting again when content that has
+just been split into simple HTML and presentation info comes back unchanged.
+"""
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.signals import request_finished
+from django.db import transaction
+from django.test.signals import setting_changed
+
+from semanticeditor.format import format_html
+from semanticeditor.layout import get_layout_details_strategy
+from semanticeditor.utils.datastructures import LRUCache
+
+# Incremented to invalidate all cached formatting results.
+GENERATION_KEY = 'semanticeditor:format:generation'
+
+_caches = {}
+
+# Used for round-trip data if there is no shared cache.
+_local_rendered_cache = []
+
+def get_shared_cache():
+    """
+    Returns the Django cache named by the SEMANTICEDITOR_FORMAT_CACHE setting,
+    or None if it is not set.
+    """
+    alias = getattr(settings, 'SEMANTICEDITOR_FORMAT_CACHE', None)
+    if alias is None:
+        return None
+    cache = _caches.get(alias)
+    if cache is None:
+        cache = _caches[alias] = get_cache(alias)
+    return cache
+
+
+def _setting_changed(sender, setting=None, **kwargs):
+    if setting == 'CACHES' or setting.startswith('SEMANTICEDITOR_'):
+        _caches.clear()
+        del _local_rendered_cache[:]
+
+setting_changed.connect(_setting_changed)
+
+
+def format_html_cached(html, styleinfo, pretty_print=False, fingerprint=None):
+    """
+    As for format_html, but uses the cache named by SEMANTICEDITOR_FORMAT_CACHE
+    (if set) to avoid formatting the same HTML and presentation info more than
+    once.  Results are kept for SEMANTICEDITOR_FORMAT_CACHE_TIMEOUT seconds
+    (defaults to the cache's own timeout).
+
+    If fingerprint is the value returned by extract_presentation, and html and
+    styleinfo are unchanged from what it returned, the HTML originally passed
+    to extract_presentation is returned without any further processing.
+    """
+    if fingerprint is not None:
+        original = get_rendered_html(fingerprint, html, styleinfo)
+        if original is not None:
+            return original
+
+    cache = get_shared_cache()
+    if cache is None:
+        return format_html(html, styleinfo, pretty_print=pretty_print)
+
+    key = _format_cache_key(cache, html, styleinfo, pretty_print)
+    retval = cache.get(key)
+    if retval is None:
+        # User errors are raised here, and so never cached.
+        retval = format_html(html, styleinfo, pretty_print=pretty_print)
+        cache.set(key, retval, getattr(settings, 'SEMANTICEDITOR_FORMAT_CACHE_TIMEOUT', None))
+    return retval
+
+
+def invalidate_format_cache():
+    """
+    Invalidates all cached format_html results, across all processes.
+    """
+    cache = get_shared_cache()
+    if cache is not None:
+        bump_shared_version(cache, GENERATION_KEY)
+
+
+def get_shared_version(cache, key):
+    """
+    Returns the version number stored in cache under key, creating it if
+    necessary.  Used for invalidating data across processes.
+    """
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _new_version())
+        version = cache.get(key, 0)
+    return version
+
+
+def bump_shared_version(cache, key):
+    """
+    Changes the version number stored in cache under key.
+    """
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Not set yet, or evicted
+        cache.set(key, _new_version())
+
+
+def invalidate_after_commit(invalidate):
+    """
+    Calls invalidate() now and, if a database transaction is in progress,
+    again when the request finishes, by which time the transaction has been
+    committed.  Used from model signal handlers, which run before the commit:
+    until then, other processes and threads can only load the old data from
+    the database, and would keep it if invalidate() was only called once.
+    """
+    invalidate()
+    if transaction.is_managed():
+        pending = getattr(_pending_invalidations, 'funcs', None)
+        if pending is None:
+            pending = _pending_invalidations.funcs = []
+        if invalidate not in pending:
+            pending.append(invalidate)
+
+_pending_invalidations = threading.local()
+
+def _request_finished(sender, **kwargs):
+    pending = getattr(_pending_invalidations, 'funcs', None)
+    if pending:
+        _pending_invalidations.funcs = []
+        for invalidate in pending:
+            invalidate()
+
+request_finished.connect(_request_finished)
+
+
+def _new_version():
+    # If a version key is evicted, we must not start again from a number
+    # that was used before, or old data would become valid again.
+    return int(time.time() * 1000)
+
+
+def _format_cache_key(cache, html, styleinfo, pretty_print):
+    h = hashlib.sha1()
+    if isinstance(html, unicode):
+        html = html.encode('utf-8')
+    h.update(html)
+    h.update("\0")
+    h.update(normalise_styleinfo(styleinfo))
+    h.update("\0")
+    h.update(get_layout_details_strategy().cache_key())
+    h.update("\0")
+    h.update(repr(bool(pretty_print)))
+    return "semanticeditor:format:%d:%s" % (get_shared_version(cache, GENERATION_KEY), h.hexdigest())
+
+
+def normalise_styleinfo(styleinfo, column_equiv=True):
+    """
+    Returns a string representing the style info dictionary, which is the same
+    for any two dictionaries that produce the same formatting.
+
+    If column_equiv is False, column_equiv values are ignored (they are not
+    known to extract_presentation).
+    """
+    # Sections with no presentation info are the same as missing sections, and
+    # the order of PresentationInfo objects doesn't matter.
+    items = []
+    for sect_id, presinfos in styleinfo.items():
+        pis = sorted(set(u"%s:%s:%s" % (pi.prestype, pi.name,
+                                        pi.column_equiv if column_equiv else None)
+                         for pi in presinfos))
+        if pis:
+            items.append(u"%s=%s" % (sect_id, u" ".join(pis)))
+    items.sort()
+    return u"\n".join(items).encode('utf-8')
+
+
+### Round-trip fast path
+
+def save_rendered_html(rendered_html, html, styleinfo):
+    """
+    Stores rendered HTML, which has been split into simple HTML and style info
+    by extract_presentation, and returns a fingerprint that can be used to
+    retrieve it with get_rendered_html.
+    """
+    fingerprint = _rendered_fingerprint(rendered_html, html, styleinfo)
+    key = "semanticeditor:rendered:%s" % fingerprint
+    cache = get_shared_cache()
+    if cache is not None:
+        cache.set(key, rendered_html, getattr(settings, 'SEMANTICEDITOR_FORMAT_CACHE_TIMEOUT', None))
+    else:
+        cache = _get_local_rendered_cache()
+        if cache is not None:
+            cache.set(key, rendered_html)
+    return fingerprint
+
+
+def get_rendered_html(fingerprint, html, styleinfo):
+    """
+    Returns the rendered HTML stored under fingerprint by save_rendered_html,
+    or None if it is not available, or if html and styleinfo are not the same
+    as when it was stored.
+    """
+    key = "semanticeditor:rendered:%s" % fingerprint
+    cache = get_shared_cache()
+    if cache is None:
+        cache = _get_local_rendered_cache()
+        if cache is None:
+            return None
+    rendered_html = cache.get(key)
+    if rendered_html is None:
+        return None
+    if _rendered_fingerprint(rendered_html, html, styleinfo) != fingerprint:
+        return None
+    return rendered_html
+
+
+def _get_local_rendered_cache():
+    if not _local_rendered_cache:
+        size = getattr(settings, 'SEMANTICEDITOR_ROUNDTRIP_CACHE_SIZE', 100)
+        _local_rendered_cache.append(LRUCache(size) if size > 0 else None)
+    return _local_rendered_cache[0]
+
+
+def _rendered_fingerprint(rendered_html, html, styleinfo):
+    h = hashlib.sha1()
+    for s in (rendered_html, html):
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        h.update(s)
+        h.update("\0")
+    h.update(normalise_styleinfo(styleinfo, column_equiv=False))
+    return h.hexdigest()
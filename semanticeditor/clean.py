@@ -2,136 +2,379 @@
 Utilities for cleaning user HTML
 """
 
+import copy
+import hashlib
+
 from lxml import etree as ET
-from pyquery import PyQuery as pq
+from pyquery.cssselectpatch import JQueryTranslator
 
 from semanticeditor.common import html_extract, parse, get_classes_for_node
 from semanticeditor.definitions import BLOCKDEF_SELECTOR, COMMANDS
-from semanticeditor.utils.etree import get_parent, get_index, eliminate_tag, empty_text
+from semanticeditor.instrumentation import count, timed
+from semanticeditor.utils.datastructures import LRUCache
+from semanticeditor.utils.etree import empty_text, pull_up_all
 from django.conf import settings
+from django.test.signals import setting_changed
+
+
+### Selectors ###
+
+# Cleaning rules are written as CSS selectors, and compiled to XPath objects
+# once, rather than every time they are used.  We use the same translator as
+# PyQuery, so that selectors (including SEMANTICEDITOR_DISALLOWED_ELEMENTS)
+# mean exactly what they would with PyQuery.
+
+_translator = JQueryTranslator()
+
+def compile_selector(selector, prefix='descendant-or-self::'):
+    """
+    Compiles a CSS selector to an lxml XPath object.  With the default
+    prefix, calling it with a node returns the matching nodes from the node
+    and its descendants.
+    """
+    return ET.XPath(_translator.css_to_xpath(selector.replace('[@', '['), prefix))
+
+_all_elements = compile_selector('*')
+_removed_elements = [compile_selector(x) for x in ['style', 'col']]
+_inline_elements = [compile_selector(x) for x in ['strong', 'em', 'b', 'i']]
+_is_block = compile_selector(BLOCKDEF_SELECTOR, prefix='self::')
+_elements_with_id = compile_selector('*[id]')
+_br = compile_selector('br')
+_empty_p = compile_selector('p:empty')
+
+
+### Settings ###
+
+def _load_settings():
+    global disallowed_elements, max_clean_passes, _disallowed_elements
+    global clean_html_cache, _config_key
+    disallowed_elements = getattr(settings, "SEMANTICEDITOR_DISALLOWED_ELEMENTS", ['span', 'li p:only-child', 'table', 'tbody', 'thead', 'tr', 'td'])
+    _disallowed_elements = [compile_selector(x) for x in disallowed_elements]
+
+    # Cleaning can need several passes, but in case some pathological input
+    # never settles down, we stop after this many.
+    max_clean_passes = getattr(settings, "SEMANTICEDITOR_CLEAN_MAX_PASSES", 10)
+
+    # Optional cache of clean_html results.  It is replaced whenever settings
+    # change, and results are keyed on the settings that affect cleaning too.
+    cache_size = getattr(settings, "SEMANTICEDITOR_CLEAN_HTML_CACHE_SIZE", 0)
+    clean_html_cache = LRUCache(cache_size) if cache_size > 0 else None
+    _config_key = repr((list(disallowed_elements), max_clean_passes))
 
-disallowed_elements = getattr(settings, "SEMANTICEDITOR_DISALLOWED_ELEMENTS", ['span', 'li p:only-child', 'table', 'tbody', 'thead', 'tr', 'td'])
+_load_settings()
 
-def clean_tree(root):
+def _setting_changed(sender, setting=None, **kwargs):
+    if setting.startswith('SEMANTICEDITOR_'):
+        _load_settings()
+
+setting_changed.connect(_setting_changed)
+
+
+def clean_tree(root, max_passes=None, promote_text=True):
+    """
+    Cleans dirty HTML from an ElementTree.
+
+    Returns the number of cleaning passes that were used, which will be at
+    most max_passes (defaults to SEMANTICEDITOR_CLEAN_MAX_PASSES setting).
+    If promote_text is False, text left directly in body is not wrapped in a
+    'p'.
+    """
+    if max_passes is None:
+        max_passes = max_clean_passes
+    # Removed elements can give problems which need to be fixed again.  We keep
+    # going until a pass doesn't change anything.
+    passes = 0
+    while passes < max_passes:
+        passes += 1
+        if not _clean_pass(root, promote_text):
+            break
+    count('clean_tree.passes', passes)
+    return passes
+
+
+def _clean_pass(root, promote_text=True):
     """
-    Cleans dirty HTML from an ElementTree
+    Does one pass of cleaning, returning True if the tree was changed.
     """
-    initial_html = ET.tostring(root)
     body = root[0] # <html><body>
+    changed = False
     # If there is text directly in body, it needs wrapping in a block element.
-    _promote_child_text(body, 'p')
+    if promote_text:
+        changed |= _promote_child_text(body, 'p')
 
     # replace 'command' divs
-    _remove_command_divs(body)
+    changed |= _remove_command_divs(body)
 
     # First replace divs
-    _replace_block_elements(body)
+    changed |= _replace_block_elements(body)
 
     # Deal with nested 'p's and other elements.
-    _clean_nested(body)
+    changed |= _clean_nested(body)
 
-    doc = pq(root)
-    doc('*').each(_clean_elem)
-    doc('style').remove()
-    doc('col').remove()
+    for n in _all_elements(root):
+        changed |= _clean_elem(n)
+    for selector in _removed_elements:
+        changed |= _remove_all(selector(root))
 
-    def pull_up(n):
-        p = get_parent(body, n)
-        i = get_index(p, n)
-        eliminate_tag(p, i)
-
-    for x in disallowed_elements: 
-        for n in doc(x):
-            pull_up(n)
+    for selector in _disallowed_elements:
+        nodes = selector(root)
+        if nodes:
+            pull_up_all(nodes)
+            changed = True
     # "li p:only-child" appears to be buggy.  It works like
     # "li p:only-descendent" or something.
 
-    for x in ['strong', 'em', 'b', 'i']:
-        for n in doc(x):
-            if pq(n).is_(BLOCKDEF_SELECTOR):
-                pull_up(n)
-
-    # remove duplicate 'id' attributes.
-    ids = [n.get('id', None) for n in doc('*[id]')]
-    ids = [i for i in ids if i != "" and i != None]
-    for i in set(ids):
-        for j, node in enumerate(doc('#' + i)):
-            if (j > 0): # skip the first one
-                del node.attrib['id']
-
-    doc('p + br').remove()
-    for par in doc('p:empty'):
+    for selector in _inline_elements:
+        nodes = [n for n in selector(root) if _is_block(n)]
+        if nodes:
+            pull_up_all(nodes)
+            changed = True
+
+    changed |= _remove_duplicate_ids(root)
+
+    changed |= _remove_all(_brs_after_p(root))
+    for par in _empty_p(root):
         if par.text is None  or par.text.strip() == "":
             par.getparent().remove(par)
+            changed = True
+
+    return changed
 
-    # Removed elements can give problems which need to be fixed again.  We keep
-    # iterating through this until we get the same answer!
-    output_html = ET.tostring(root)
-    if initial_html == output_html:
-        return
-    else:
-        clean_tree(root)
+
+# Top level elements that clean_tree treats differently depending on their
+# neighbours, so can't be cleaned on their own.
+_neighbour_dependent = set(['br', 'style', 'col'])
+
+def clean_tree_by_element(root, cache):
+    """
+    Cleans a tree in the same way as clean_tree, but one top level element at
+    a time, so that the result of cleaning an element can be reused.  'cache'
+    is a dictionary of the cleaned versions of top level elements, keyed on
+    their HTML, as returned by the previous call.
+
+    Returns a new tree, and a new cache containing just the elements of this
+    tree.  If the tree can't be cleaned an element at a time, because cleaning
+    some element would affect its neighbours, returns (None, None).
+    """
+    body = root[0] # <html><body>
+    if not empty_text(body.text):
+        return None, None
+    new_root = ET.fromstring("<html><body></body></html>")
+    new_body = new_root[0]
+    new_body.text = body.text
+    new_cache = {}
+    for n in body:
+        key = ET.tostring(n)
+        if key in new_cache:
+            cleaned = new_cache[key]
+        elif key in cache:
+            cleaned = cache[key]
+        else:
+            cleaned = _clean_element(n)
+        new_cache[key] = cleaned
+        if cleaned is None:
+            return None, None
+        if len(cleaned):
+            new_body.append(copy.deepcopy(cleaned[0]))
+    _remove_duplicate_ids(new_root)
+    return new_root, new_cache
+
+
+def _clean_element(elem):
+    # Returns a tuple containing the cleaned version of a top level element,
+    # an empty tuple if cleaning removes it, or None if it can't be cleaned on
+    # its own.
+    if not isinstance(elem.tag, basestring) or elem.tag in _neighbour_dependent:
+        return None
+    root = ET.fromstring("<html><body></body></html>")
+    body = root[0]
+    body.append(copy.deepcopy(elem))
+    ids = [n.get('id') for n in _elements_with_id(body)]
+    # Text that is left directly in body would be wrapped in a 'p' here, but
+    # joined to the previous element when the whole document is cleaned.
+    clean_tree(root, promote_text=False)
+    # Anything left directly in body would end up in the neighbouring
+    # elements, and ids that are removed might have been duplicates of ids
+    # in other elements (whose duplicates should then have been removed).
+    if (not empty_text(body.text) or len(body) > 1 or
+        (len(body) == 1 and not empty_text(body[0].tail)) or
+        ids != [n.get('id') for n in _elements_with_id(body)]):
+        return None
+    if len(body) == 0:
+        return ()
+    if body[0].tag in _neighbour_dependent:
+        return None
+    return (body[0],)
 
 
 def clean_html(html):
-    tree = parse(html, clean=True)
-    return html_extract(tree)
+    """
+    Returns cleaned version of the HTML.  Results are cached if the
+    SEMANTICEDITOR_CLEAN_HTML_CACHE_SIZE setting is non-zero.
+    """
+    with timed('clean_html', len(html)):
+        cache = clean_html_cache
+        if cache is None:
+            return _clean_html(html)
+        key = _clean_html_cache_key(html)
+        retval = cache.get(key)
+        if retval is None:
+            retval = _clean_html(html)
+            cache.set(key, retval)
+        return retval
+
+
+def _clean_html(html):
+    size = len(html)
+    with timed('clean_html.parse', size):
+        tree = parse(html)
+    with timed('clean_html.clean', size):
+        clean_tree(tree)
+    with timed('clean_html.serialize', size):
+        return html_extract(tree)
+
+
+def _clean_html_cache_key(html):
+    if isinstance(html, unicode):
+        html = html.encode('utf-8')
+    return hashlib.sha1(_config_key + "\0" + html).hexdigest()
+
+
+def _remove_duplicate_ids(root):
+    """
+    Removes 'id' attributes that duplicate an earlier one in the document.
+    Returns True if any were removed.
+    """
+    changed = False
+    seen = set()
+    for node in _elements_with_id(root):
+        i = node.get('id')
+        if i == "":
+            continue
+        if i in seen:
+            del node.attrib['id']
+            changed = True
+        else:
+            seen.add(i)
+    return changed
+
+
+def _brs_after_p(root):
+    """
+    Returns the nodes matching 'p + br'
+    """
+    # libxml2 evaluates the XPath for this selector in quadratic time when
+    # there are many siblings, so it is done by hand.
+    retval = []
+    for br in _br(root):
+        prev = br.getprevious()
+        while prev is not None and not isinstance(prev.tag, basestring):
+            # skip comments etc.
+            prev = prev.getprevious()
+        if prev is not None and prev.tag == 'p':
+            retval.append(br)
+    return retval
+
+
+def _remove_all(nodes):
+    """
+    Removes nodes from the tree, keeping their tail text (in the same way as
+    PyQuery.remove).  Returns True if there were any nodes.
+    """
+    for node in nodes:
+        parent = node.getparent()
+        if parent is not None:
+            if node.tail:
+                prev = node.getprevious()
+                if prev is None:
+                    parent.text = (parent.text or '') + ' ' + node.tail
+                else:
+                    prev.tail = (prev.tail or '') + ' ' + node.tail
+            parent.remove(node)
+    return len(nodes) > 0
 
 
 def _clean_text(t):
     return t.replace(u'\xa0', u' ')
 
 
-def _clean_elem(i, d):
+def _clean_elem(d):
+    changed = False
     for x in ['style', 'class']:
         try:
             del d.attrib[x]
+            changed = True
         except KeyError:
             pass
     for elem in d:
         if elem.text is not None:
-            elem.text = _clean_text(elem.text)
+            text = _clean_text(elem.text)
+            if text != elem.text:
+                elem.text = text
+                changed = True
         if elem.tail is not None:
-            elem.tail = _clean_text(elem.tail)
+            tail = _clean_text(elem.tail)
+            if tail != elem.tail:
+                elem.tail = tail
+                changed = True
+    return changed
 
 
 def _promote_child_text(elem, tag):
     """
     Ensure any leading or trailing text directly as a child of elem is wrapped
-    in a tag.
+    in a tag.  Returns True if any changes were made.
     """
+    changed = False
     if not empty_text(elem.text):
         newtag = ET.Element(tag)
         newtag.text = elem.text
         elem.insert(0, newtag)
         elem.text = None
+        changed = True
 
     if len(elem) > 0 and not empty_text(elem[-1].tail):
         newtag = ET.Element(tag)
         newtag.text = elem[-1].tail
         elem[-1].tail = None
         elem.append(newtag)
+        changed = True
+    return changed
 
 
 def _clean_nested(elem):
-    for idx, child in reversed(list(enumerate(elem.getchildren()))):
-        # (do it reversed so that indexes never change as we mutate children)
-        _clean_nested(child)
+    changed = False
+    nested = []
+    for child in elem.getchildren():
+        changed |= _clean_nested(child)
         if child.tag == 'p' and elem.tag == 'p':
-            eliminate_tag(elem, idx)
+            nested.append(child)
+    if nested:
+        # Last first, as the tags used to be eliminated one at a time from the
+        # end, so that the text ends up in the same places.
+        nested.reverse()
+        pull_up_all(nested)
+        changed = True
+    return changed
 
 
 def _replace_block_elements(elem):
+    changed = False
     for child in elem.getchildren():
         if child.tag == 'div':
             child.tag = 'p'
-        _replace_block_elements(child)
+            changed = True
+        changed |= _replace_block_elements(child)
+    return changed
 
 
 def _remove_command_divs(elem):
+    changed = False
     for child in reversed(elem.getchildren()):
-        _remove_command_divs(child)
+        changed |= _remove_command_divs(child)
         if child.tag == 'div' or child.tag == 'p':
             classes = set(get_classes_for_node(child))
             if any(c.name in classes for c in COMMANDS):
                 elem.remove(child)
+                changed = True
+    return changed
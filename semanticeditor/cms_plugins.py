@@ -5,17 +5,50 @@ from cms.plugins.text.forms import TextForm
 from cms.plugins.text.utils import plugin_tags_to_user_html
 from cms.plugin_pool import plugin_pool
 from cms.plugin_base import CMSPluginBase
+from django import forms
+from django.utils import simplejson
 from django.utils.translation import ugettext_lazy as _
 
+from semanticeditor.api import AllUserErrors
+from semanticeditor.views import combine
 from semanticeditor.widgets import SemanticEditor
 from django.forms.fields import CharField
 
 import re
 
+
+class SemanticTextPluginForm(TextForm):
+    """
+    Form that takes content HTML and presentation info separately, as they
+    are held by the editor, and combines them when the form is validated.
+    If the presentation field is empty, 'body' is saved as it is.
+    """
+    semantic_presentation = CharField(widget=forms.HiddenInput, required=False)
+    semantic_fingerprint = CharField(widget=forms.HiddenInput, required=False)
+
+    def clean(self):
+        cleaned_data = super(SemanticTextPluginForm, self).clean()
+        presentation = cleaned_data.get('semantic_presentation')
+        if not presentation or 'body' not in cleaned_data:
+            return cleaned_data
+        try:
+            presentation = simplejson.loads(presentation)
+        except ValueError:
+            presentation = None
+        if not isinstance(presentation, dict):
+            raise forms.ValidationError(_("Layout and styles could not be read, please try again."))
+        try:
+            cleaned_data['body'] = combine(cleaned_data['body'], presentation,
+                                           cleaned_data.get('semantic_fingerprint') or None)
+        except AllUserErrors, e:
+            raise forms.ValidationError(e.args[0])
+        return cleaned_data
+
 class SemanticTextPlugin(TextPlugin):
 
     name = _("Text/layout")
     admin_preview = False
+    form = SemanticTextPluginForm
 
     # A lot of duplication from TextPlugin because get_form needs to find out
     # what page/template we are using, and pass that on to get_editor_widget
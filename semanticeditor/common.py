@@ -7,18 +7,30 @@ from lxml import etree as ET
 from lxml.html import HTMLParser
 
 from semanticeditor.definitions import IncorrectHeadings, BLOCKDEF, BLOCK_LEVEL_TRIM_LENGTH, HEADINGDEF
-from semanticeditor.utils.datastructures import struct
-from semanticeditor.utils.etree import flatten, get_depth, cleanup
+from semanticeditor.utils.etree import TextFlattener, iter_with_depth, cleanup
 
 ### Structure related ###
 
 class StructureItem(object):
-    __metaclass__ = struct
-    level = 0     #    level is the 'outline level' in the document i.e. an integer
-    sect_id = ''  #    sect_id is a unique ID used for storing presentation information against
-    name = ''     #    name is a user presentable name for the section
-    tag = ''      #    tag is the HTML element e.g. h1
-    node = None   #    node is the ElementTree node
+    # One of these is created for every block level element in a document, so
+    # __slots__ is used to keep them small and fast to create.
+    __slots__ = ('level',    # level is the 'outline level' in the document i.e. an integer
+                 'sect_id',  # sect_id is a unique ID used for storing presentation information against
+                 'name',     # name is a user presentable name for the section
+                 'tag',      # tag is the HTML element e.g. h1
+                 'node',     # node is the ElementTree node
+                 )
+
+    def __init__(self, level=0, sect_id='', name='', tag='', node=None):
+        self.level = level
+        self.sect_id = sect_id
+        self.name = name
+        self.tag = tag
+        self.node = node
+
+    def __repr__(self):
+        return u"<StructureItem %s>" % u' '.join(u"%s=%r" % (k, getattr(self, k))
+                                                 for k in sorted(self.__slots__))
 
 
 def get_structure(root, assert_structure=False):
@@ -27,11 +39,12 @@ def get_structure(root, assert_structure=False):
     are nodes that can have commands or classes applied to them.
     """
     retval = []
-    sect_ids = set()
+    sect_ids = SectIdAllocator()
     headings_used = False
     cur_level = 1
     last_heading_num = 0
     first_heading_level = 1
+    flattener = TextFlattener()
 
     # Pre-pass to get existing ids.
     for n in root.getiterator():
@@ -42,18 +55,17 @@ def get_structure(root, assert_structure=False):
                     # don't use duplicate ids.
                     del n.attrib['id']
                 else:
-                    # reserve
-                    sect_ids.add(sect_id)
+                    sect_ids.reserve(sect_id)
 
-    for n in root.getiterator():
+    # Depth is tracked as we go, rather than being looked up for each node,
+    # which would make this quadratic in the size of the document.
+    for n, depth in iter_with_depth(root):
         if n.tag in BLOCKDEF:
-            text = flatten(n)
             sect_id = n.get('id')
             if sect_id is None:
-                sect_id = _make_sect_id(n.tag, sect_ids)
-            sect_ids.add(sect_id)
+                sect_id = sect_ids.allocate(n.tag)
             if n.tag in HEADINGDEF:
-                name = text
+                name = flattener.flatten(n)
                 level = int(n.tag[1])
                 cur_level = level
                 if assert_structure:
@@ -78,7 +90,8 @@ def get_structure(root, assert_structure=False):
                 last_heading_num = level
                 headings_used = True
             else:
-                name = text[0:BLOCK_LEVEL_TRIM_LENGTH]
+                # Only as much text as we are going to use is extracted.
+                name = flattener.flatten(n, BLOCK_LEVEL_TRIM_LENGTH)[0:BLOCK_LEVEL_TRIM_LENGTH]
                 if name == '':
                     name = '?'
                 else:
@@ -95,24 +108,47 @@ def get_structure(root, assert_structure=False):
             # the first to appear in the document.
             # It is also adjusted so that nested items (e.g. p in blockquote)
             # appear to be nested.
-            nesting_level = get_depth(root, n) - 2
-            retval.append(StructureItem(level=nesting_level + level - first_heading_level + 1,
-                                        sect_id=sect_id,
-                                        name=name,
-                                        tag=n.tag.lower(),
-                                        node=n))
+            nesting_level = depth - 2
+            retval.append(StructureItem(nesting_level + level - first_heading_level + 1,
+                                        sect_id,
+                                        name,
+                                        n.tag.lower(),
+                                        n))
 
     return retval
 
 
-def _make_sect_id(tag, used_ids):
-    i = 1
-    while True:
-        attempt = tag + "_" + str(i)
-        if attempt not in used_ids:
-            return attempt
-        else:
+class SectIdAllocator(object):
+    """
+    Allocates unique section ids of the form 'tag_N', using the lowest N that
+    has not already been used.
+
+    Ids already present in the document must be registered using reserve().
+    For each tag, the lowest N that could still be free is remembered, so
+    allocating an id does not involve probing all the ids used so far.
+    """
+    def __init__(self):
+        self.used = set()
+        self._next_num = {}
+
+    def __contains__(self, sect_id):
+        return sect_id in self.used
+
+    def reserve(self, sect_id):
+        self.used.add(sect_id)
+
+    def allocate(self, tag):
+        # All ids below the high-water mark are in use, and ids are never
+        # released, so we can start searching from there.
+        i = self._next_num.get(tag, 1)
+        while True:
+            attempt = "%s_%d" % (tag, i)
+            if attempt not in self.used:
+                break
             i += 1
+        self._next_num[tag] = i + 1
+        self.used.add(attempt)
+        return attempt
 
 
 def parse(content, clean=False):
@@ -130,8 +166,86 @@ def parse(content, clean=False):
     return tree
 
 
-def html_extract(root):
-    return ET.tostring(root).replace('<html>', '').replace('</html>', '').replace('<body>', '').replace('</body>', '').replace('<body/>','').replace("<head/>", "").replace("&#13;", "\r")
+def html_extract(root, encoding=None):
+    """
+    Returns the HTML contained in the tree, without the <html> and <body>
+    wrappers added by parse().
+
+    By default, non-ASCII characters are output as character references, as
+    ET.tostring() does.  If 'encoding' is given (e.g. 'utf-8'), the HTML is
+    returned as bytes in that encoding, suitable for writing directly to a
+    response.  Only encodings in which ASCII characters are single bytes
+    (e.g. utf-8, latin-1) are supported - ValueError is raised for others
+    (e.g. utf-16).
+    """
+    # The body's text and children are serialised individually, so that the
+    # wrapper tags never have to be removed from the output.
+    if encoding is None:
+        kwargs = {}
+    else:
+        if not _is_ascii_compatible(encoding):
+            raise ValueError("html_extract does not support the encoding '%s'" % encoding)
+        kwargs = dict(encoding=encoding, xml_declaration=False)
+    pieces = []
+    if root.text:
+        pieces.append(_serialize_text(root.text, kwargs))
+    for child in root:
+        if child.tag == 'body':
+            if child.text:
+                pieces.append(_serialize_text(child.text, kwargs))
+            for n in child:
+                pieces.append(_restore_cr(ET.tostring(n, **kwargs)))
+            if child.tail:
+                pieces.append(_serialize_text(child.tail, kwargs))
+        elif child.tag == 'head' and len(child) == 0 and not child.text:
+            continue
+        else:
+            pieces.append(_restore_cr(ET.tostring(child, **kwargs)))
+    if root.tail:
+        pieces.append(_serialize_text(root.tail, kwargs))
+    return "".join(pieces)
+
+
+def html_extract_fragments(root):
+    """
+    Returns the HTML in the body of a tree created by parse() as a list of
+    strings, one for each top level element (including the text following
+    it), and one for any text before the first element.  Joined together,
+    they are the same as html_extract(root).
+    """
+    body = root.find('body')
+    if body is None:
+        return [html_extract(root)]
+    pieces = []
+    if body.text:
+        pieces.append(_serialize_text(body.text, {}))
+    for n in body:
+        pieces.append(_restore_cr(ET.tostring(n)))
+    return pieces
+
+
+def _is_ascii_compatible(encoding):
+    # Pieces are serialised separately and joined, and text is removed from
+    # a wrapper by slicing, which only works if ASCII characters are encoded
+    # as themselves and there is no byte order mark.
+    try:
+        return u"<x>&#13;</x>".encode(encoding) == "<x>&#13;</x>"
+    except (LookupError, UnicodeError):
+        return False
+
+
+def _serialize_text(text, kwargs):
+    # Let lxml do the escaping, so it is identical to the rest of the output.
+    holder = ET.Element('x')
+    holder.text = text
+    return _restore_cr(ET.tostring(holder, **kwargs)[len('<x>'):-len('</x>')])
+
+
+def _restore_cr(html):
+    # lxml escapes '\r', which we don't want.
+    if "&#13;" in html:
+        html = html.replace("&#13;", "\r")
+    return html
 
 
 def get_classes_for_node(node):
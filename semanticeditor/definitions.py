@@ -47,12 +47,15 @@ class PresentationInfo(object):
             allowed_elements = []
         self.allowed_elements = allowed_elements
         self.column_equiv = column_equiv
+        # These objects are used a lot in sets, so the hash is only
+        # calculated once.
+        self._hash = hash(prestype) ^ hash(name)
 
     def __eq__(self, other):
-        return self.prestype == other.prestype and self.name == other.name
+        return self is other or (self.prestype == other.prestype and self.name == other.name)
 
     def __hash__(self):
-        return hash(self.prestype) ^ hash(self.name)
+        return self._hash
 
     def __repr__(self):
         return "PresentationInfo(prestype=\"%s\", name=\"%s\")" % (self.prestype, self.name)
@@ -160,3 +163,74 @@ SORTED_COMMANDS = sorted(COMMANDS, key=lambda c: c.layout_order)
 for i, c in enumerate(SORTED_COMMANDS):
     # Several places that index SORTED_COMMANDS make this assumption:
     assert c.layout_order == i
+
+
+### Shared PresentationInfo objects ###
+
+# (prestype, name) -> PresentationInfo
+_interned = {}
+
+# Class names come from user HTML, so we need a limit.
+MAX_INTERNED = 10000
+
+
+def get_presentation_info(prestype, name):
+    """
+    Returns a PresentationInfo for the prestype and name, with no other
+    information (such as verbose_name) filled in, except for commands, which
+    are the objects defined above.  The same object is returned each time,
+    and it cannot be changed.
+    """
+    key = (prestype, name)
+    pi = _interned.get(key)
+    if pi is None:
+        if prestype == 'class':
+            pi = PresentationClass(name)
+        else:
+            pi = PresentationInfo(prestype=prestype, name=name)
+        if len(_interned) < MAX_INTERNED:
+            freeze_presentation_info(pi)
+            pi = _interned.setdefault(key, pi)
+    return pi
+
+
+class _Frozen(object):
+    """
+    Mixin for PresentationInfo objects that are shared, which stops them from
+    being changed.
+    """
+    def __setattr__(self, name, value):
+        raise AttributeError("Shared %s objects cannot be changed" % self.__class__.__bases__[1].__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError("Shared %s objects cannot be changed" % self.__class__.__bases__[1].__name__)
+
+
+# These are defined at module level so that shared objects can be pickled.
+class _FrozenPresentationInfo(_Frozen, PresentationInfo):
+    pass
+
+class _FrozenPresentationClass(_Frozen, PresentationClass):
+    pass
+
+class _FrozenPresentationCommand(_Frozen, PresentationCommand):
+    pass
+
+_frozen_classes = {
+    PresentationInfo: _FrozenPresentationInfo,
+    PresentationClass: _FrozenPresentationClass,
+    PresentationCommand: _FrozenPresentationCommand,
+}
+
+
+def freeze_presentation_info(pi):
+    """
+    Stops a PresentationInfo from being changed, so that it can be shared.
+    """
+    if not isinstance(pi, _Frozen):
+        pi.__class__ = _frozen_classes[pi.__class__]
+
+
+for c in COMMANDS:
+    freeze_presentation_info(c)
+    _interned[(c.prestype, c.name)] = c
@@ -2,8 +2,10 @@
 Extract simple HTML and presentation info from combined HTML
 """
 
+from semanticeditor.caching import save_rendered_html
 from semanticeditor.common import parse, get_structure, get_classes_for_node, html_extract, strip_presentation
-from semanticeditor.definitions import PresentationClass, NEWROW, NEWCOL, NEWINNERROW, NEWINNERCOL
+from semanticeditor.definitions import get_presentation_info, NEWROW, NEWCOL, NEWINNERROW, NEWINNERCOL
+from semanticeditor.instrumentation import timed
 from semanticeditor.layout import get_layout_details_strategy
 from semanticeditor.utils.etree import get_parent, get_index
 from semanticeditor.utils.general import any
@@ -21,66 +23,85 @@ def extract_structure(content):
     return structure
 
 
-def extract_presentation(html):
+def extract_presentation(html, return_fingerprint=False):
     """
     Takes HTML with formatting applied and returns presentation elements (a
     dictionary with keys = section names, values = set of classes/commands) and
     the HTML without formatting (ready to be used in an editor)
+
+    If return_fingerprint is True, a third value is returned, which can be
+    passed to format_html_cached to get the original HTML back if neither
+    return value is changed.
     """
+    with timed('extract_presentation', len(html)):
+        return _extract_presentation(html, return_fingerprint)
+
+
+def _extract_presentation(html, return_fingerprint):
+    rendered_html = html
+    size = len(html)
     # TODO: this function is not brilliantly well defined e.g.  should
     # there be an entry in the dictionary for sections with no
     # formatting?  This does not affect functionality, but it does
     # affect tests.
     layout_strategy = get_layout_details_strategy()
-    html = layout_strategy.extract_pre_parse_hacks(html)
-    root = parse(html, clean=False) # it's important we don't clean.
-    root = layout_strategy.extract_post_parse_hacks(root)
-    structure = get_structure(root)
-    structure = layout_strategy.extract_structure_hacks(structure)
-    pres = {}
-    layout_commands = find_all_layout_nodes(root, layout_strategy)
-    for si in structure:
-        pres[si.sect_id] = set()
-
-        # Section - extract classes
-        for c in get_classes_for_node(si.node):
-            pres[si.sect_id].add(PresentationClass(c))
-            if 'class' in si.node.attrib:
-                del si.node.attrib['class']
-
-        # Add custom ids.  These are only for purpose of editing,
-        # and will be removed again at end of format_html
-        si.node.set('id', si.sect_id)
-
-        # Now, deal with layout divs for this structure item
-        cmd_pairs = layout_commands.get(si.node, [])
-        for cmd, div_node in cmd_pairs:
-            # Need to create another entry in pres
-            pres_name = cmd.prefix + si.sect_id
-            cmd_classes = set()
-
-            # Find the classes that correspond to PresentationClass objects and
-            # add them.
-            node_classes = set(get_classes_for_node(div_node))
-            if cmd in (NEWROW, NEWINNERROW):
-                filterfunc = layout_strategy.is_row_class
-            else:
-                filterfunc = layout_strategy.is_column_class
-                # Need the classes from the inner column div
-                children = div_node.getchildren()
-                if len(children) > 0 and children[0].tag == 'div':
-                    node_classes |= set(get_classes_for_node(children[0]))
-
-            for c in node_classes:
-                if not filterfunc(c):
-                    cmd_classes.add(PresentationClass(c))
-
-            cmd_classes.add(cmd) # not strictly necessary, but helps testing
-            pres[pres_name] = cmd_classes
-
-    strip_presentation(root)
-    out_html = html_extract(root)
-
+    with timed('extract_presentation.pre_parse_hacks', size):
+        html = layout_strategy.extract_pre_parse_hacks(html)
+    with timed('extract_presentation.parse', size):
+        root = parse(html, clean=False) # it's important we don't clean.
+    with timed('extract_presentation.post_parse_hacks', size):
+        root = layout_strategy.extract_post_parse_hacks(root)
+    with timed('extract_presentation.structure', size):
+        structure = get_structure(root)
+        structure = layout_strategy.extract_structure_hacks(structure)
+    with timed('extract_presentation.layout', size):
+        pres = {}
+        layout_commands = find_all_layout_nodes(root, layout_strategy)
+        for si in structure:
+            pres[si.sect_id] = set()
+
+            # Section - extract classes
+            for c in get_classes_for_node(si.node):
+                pres[si.sect_id].add(get_presentation_info('class', c))
+                if 'class' in si.node.attrib:
+                    del si.node.attrib['class']
+
+            # Add custom ids.  These are only for purpose of editing,
+            # and will be removed again at end of format_html
+            si.node.set('id', si.sect_id)
+
+            # Now, deal with layout divs for this structure item
+            cmd_pairs = layout_commands.get(si.node, [])
+            for cmd, div_node in cmd_pairs:
+                # Need to create another entry in pres
+                pres_name = cmd.prefix + si.sect_id
+                cmd_classes = set()
+
+                # Find the classes that correspond to PresentationClass objects and
+                # add them.
+                node_classes = set(get_classes_for_node(div_node))
+                if cmd in (NEWROW, NEWINNERROW):
+                    filterfunc = layout_strategy.is_row_class
+                else:
+                    filterfunc = layout_strategy.is_column_class
+                    # Need the classes from the inner column div
+                    children = div_node.getchildren()
+                    if len(children) > 0 and children[0].tag == 'div':
+                        node_classes |= set(get_classes_for_node(children[0]))
+
+                for c in node_classes:
+                    if not filterfunc(c):
+                        cmd_classes.add(get_presentation_info('class', c))
+
+                cmd_classes.add(cmd) # not strictly necessary, but helps testing
+                pres[pres_name] = cmd_classes
+
+    with timed('extract_presentation.serialize', size):
+        strip_presentation(root)
+        out_html = html_extract(root)
+
+    if return_fingerprint:
+        return (pres, out_html, save_rendered_html(rendered_html, out_html, pres))
     return (pres, out_html)
 
 
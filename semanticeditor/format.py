@@ -3,9 +3,11 @@ Combine simple HTML and presentation info into rendered HTML
 """
 from lxml import etree as ET
 
-from semanticeditor.common import strip_presentation, get_classes_from_presinfo, html_extract, parse, get_structure
+from semanticeditor.clean import clean_tree, clean_tree_by_element
+from semanticeditor.common import strip_presentation, get_classes_from_presinfo, html_extract, html_extract_fragments, parse, get_structure
 from semanticeditor.definitions import PREVIEW_BLOCKDEF, BLOCKDEF
-from semanticeditor.layout import create_layout, check_layout, get_layout_details_strategy
+from semanticeditor.layout import create_layout, check_layout, get_layout_details_strategy, NodeContent
+from semanticeditor.instrumentation import timed
 from semanticeditor.utils.etree import indent
 
 ## Main functions and sub functions
@@ -15,88 +17,281 @@ def format_html(html, styleinfo, return_tree=False, pretty_print=False):
     The dictionary has keys which are the ids of sections,
     and values which are lists of CSS classes or special commands.
     """
+    with timed('format_html', len(html)):
+        return _format_html(html, styleinfo, return_tree, pretty_print)
+
+
+def _format_html(html, styleinfo, return_tree, pretty_print):
+    size = len(html)
     layout_strategy = get_layout_details_strategy()
-    html = layout_strategy.format_pre_parse_hacks(html, styleinfo)
-    root = parse(html, clean=True)
-    root = layout_strategy.format_post_parse_hacks(root, styleinfo)
-    structure = get_structure(root, assert_structure=True)
-    structure = layout_strategy.format_structure_hacks(structure, styleinfo)
+    rendered, structure, styleinfo = _layout_html(html, styleinfo, layout_strategy,
+                                                  'format_html', size)
+
+    with timed('format_html.classes', size):
+        # Apply normal CSS classes.
+        for si in structure:
+            _apply_classes(si, styleinfo)
+
+    # Apply hacks
+    with timed('format_html.post_layout_hacks', size):
+        rendered = layout_strategy.format_post_layout_hacks(rendered, structure, styleinfo)
+
+    with timed('format_html.serialize', size):
+        # Pretty print
+        if pretty_print:
+            indent(rendered)
+
+        # Remove the temporary IDs we may have added when splitting the HTML
+        # into content and presentation.  We don't do this before this point,
+        # as the IDs need to be there to identify sections
+        for si in structure:
+            if 'id' in si.node.attrib:
+                del si.node.attrib['id']
+
+        if return_tree:
+            return (rendered, structure)
+        else:
+            return html_extract(rendered)
+
+
+def _parse_html(html, styleinfo, layout_strategy, stage, size):
+    # Parses and cleans the HTML.
+    with timed(stage + '.pre_parse_hacks', size):
+        html = layout_strategy.format_pre_parse_hacks(html, styleinfo)
+    with timed(stage + '.parse', size):
+        root = parse(html)
+    with timed(stage + '.clean', size):
+        clean_tree(root)
+    return root
+
+
+def _layout_html(html, styleinfo, layout_strategy, stage, size):
+    # Parses and cleans the HTML, and puts the nodes into a new tree with the
+    # row/column structure.  Returns the new tree, the structure and the
+    # sanitised style info.
+    root = _parse_html(html, styleinfo, layout_strategy, stage, size)
+    layout, structure, styleinfo = _create_layout(root, styleinfo, layout_strategy, stage, size)
+
+    with timed(stage + '.layout', size):
+        # Create new ET tree from layout.  The individual nodes that belong to
+        # 'root' are not altered, but just added to a new tree.  This means that the
+        # information in 'structure' does not need updating.
+        nodes = []
+
+        for content in layout.content:
+            nodes.extend(content.as_nodes(layout_strategy))
+        rendered = ET.fromstring("<html><body></body></html>")
+        rendered.getchildren()[0].extend(nodes)
+
+    return rendered, structure, styleinfo
+
+
+def _create_layout(root, styleinfo, layout_strategy, stage, size):
+    # Takes a parsed and cleaned tree, and returns the Layout, the structure
+    # and the sanitised style info.
+    with timed(stage + '.post_parse_hacks', size):
+        root = layout_strategy.format_post_parse_hacks(root, styleinfo)
+    with timed(stage + '.structure', size):
+        structure = get_structure(root, assert_structure=True)
+        structure = layout_strategy.format_structure_hacks(structure, styleinfo)
     sect_ids = [s.sect_id for s in structure]
     styleinfo = _sanitise_styleinfo(styleinfo, sect_ids)
 
-    # Strip existing divs, otherwise we cannot format properly.  If
-    # there are other block level elements that mess things up, we
-    # raise BadStructure later, but divs have no semantics so can just
-    # be removed.
-    strip_presentation(root)
-
-    # Apply normal CSS classes.
-    for si in structure:
-        # Apply css styles
-        classes = get_classes_from_presinfo(styleinfo[si.sect_id])
-        classes.sort()
-        if classes:
-            si.node.set("class", " ".join(classes))
-
-    # Create layout from row/column commands
-    layout = create_layout(root, styleinfo, structure)
-    for c in layout.content:
-        check_layout(c, structure, layout_strategy)
-    # Create new ET tree from layout.  The individual nodes that belong to
-    # 'root' are not altered, but just added to a new tree.  This means that the
-    # information in 'structure' does not need updating.
+    with timed(stage + '.layout', size):
+        # Strip existing divs, otherwise we cannot format properly.  If
+        # there are other block level elements that mess things up, we
+        # raise BadStructure later, but divs have no semantics so can just
+        # be removed.
+        strip_presentation(root)
+
+        # Create layout from row/column commands
+        layout = create_layout(root, styleinfo, structure)
+        sect_dict = dict((si.node, si) for si in structure)
+        for c in layout.content:
+            check_layout(c, structure, layout_strategy, sect_dict=sect_dict)
+
+    return layout, structure, styleinfo
+
+
+def _apply_classes(si, styleinfo):
+    classes = get_classes_from_presinfo(styleinfo[si.sect_id])
+    classes.sort()
+    if classes:
+        si.node.set("class", " ".join(classes))
+
+
+def preview_html(html, pres):
+    size = len(html)
+    with timed('preview_html', size):
+        root = _preview_tree(html, pres, size)
+        with timed('preview_html.serialize', size):
+            return html_extract(root)
+
+
+def preview_tree(html, pres):
+    """
+    Returns the tree that preview_html serialises, as created by parse().
+    """
+    size = len(html)
+    with timed('preview_html', size):
+        return _preview_tree(html, pres, size)
+
+
+def _preview_tree(html, pres, size):
+    # A preview only shows the row/column structure and the name of each top
+    # level section.  If the layout strategy's hacks can be applied to single
+    # sections, it is built directly from the layout, skipping everything
+    # else format_html does.  Otherwise the hacks may depend on the whole of
+    # the formatted document, so that is needed.
+    layout_strategy = get_layout_details_strategy()
+    if not layout_strategy.per_node_preview_hacks:
+        root, structure = format_html(html, pres, return_tree=True)
+        with timed('preview_html.preview', size):
+            known_nodes = dict((si.node, si) for si in structure if si.tag in PREVIEW_BLOCKDEF)
+            _create_preview(root, known_nodes)
+        return root
+
+    root = _parse_html(html, pres, layout_strategy, 'preview_html', size)
+    layout, structure, styleinfo = _create_layout(root, pres, layout_strategy,
+                                                  'preview_html', size)
+    with timed('preview_html.preview', size):
+        known_nodes = dict((si.node, si) for si in structure if si.tag in PREVIEW_BLOCKDEF)
+        rendered = ET.fromstring("<html><body></body></html>")
+        rendered[0].extend(_preview_nodes(layout.content, known_nodes, structure, styleinfo,
+                                          layout_strategy))
+        return rendered
+
+
+def _preview_nodes(contents, known_nodes, structure, styleinfo, layout_strategy):
+    # Returns the preview of a list of parts of a Layout, as a list of nodes:
+    # the row and column divs, and the sections in known_nodes (a dictionary
+    # of node: StructureItem) as they are shown by _create_preview.  Other
+    # nodes of the document are left out.
+    def preview_node(n):
+        sect = known_nodes.get(n)
+        if sect is None:
+            return []
+        # Get the node into the state format_html would leave it in, as far
+        # as the preview can tell.
+        _apply_classes(sect, styleinfo)
+        layout_strategy.format_preview_hacks(n, structure, styleinfo)
+        if not (n.tag in BLOCKDEF or n.tag == 'div'):
+            return []
+        if 'id' in n.attrib:
+            del n.attrib['id']
+        _preview_section(n, sect)
+        return [n]
+
     nodes = []
+    for content in contents:
+        nodes.extend(content.as_nodes(layout_strategy, preview_node))
+    return nodes
 
-    for content in layout.content:
-        nodes.extend(content.as_nodes(layout_strategy))
-    rendered = ET.fromstring("<html><body></body></html>")
-    rendered.getchildren()[0].extend(nodes)
 
-    # Apply hacks
-    rendered = layout_strategy.format_post_layout_hacks(rendered, structure, styleinfo)
+class PreviewCache(object):
+    """
+    The parts of a preview made by preview_fragments that can be reused for
+    the next preview of the same document: the cleaned top level elements
+    (see clean_tree_by_element), and the fragments of each row of the layout.
+    """
+    def __init__(self):
+        self.elements = {}
+        self.rows = {}
 
-    # Pretty print
-    if pretty_print:
-        indent(rendered)
 
-    # Remove the temporary IDs we may have added when splitting the HTML
-    # into content and presentation.  We don't do this before this point,
-    # as the IDs need to be there to identify sections
-    for si in structure:
-        if 'id' in si.node.attrib:
-            del si.node.attrib['id']
+def preview_fragments(html, pres, cache):
+    """
+    Returns the preview of the HTML as a list of fragments, the same as
+    html_extract_fragments(preview_tree(html, pres)).
 
-    if return_tree:
-        return (rendered, structure)
-    else:
-        return html_extract(rendered)
+    Top level elements that were in the last document previewed with 'cache',
+    a PreviewCache, are not cleaned again, and rows of the layout that are
+    unchanged are not rendered again.  The cache is updated for the next
+    preview.  This needs a layout strategy with per_node_preview_hacks,
+    otherwise the whole document is previewed each time.
+    """
+    size = len(html)
+    with timed('preview_html', size):
+        layout_strategy = get_layout_details_strategy()
+        root = None
+        if layout_strategy.per_node_preview_hacks:
+            with timed('preview_html.pre_parse_hacks', size):
+                html2 = layout_strategy.format_pre_parse_hacks(html, pres)
+            with timed('preview_html.parse', size):
+                root = parse(html2)
+            with timed('preview_html.clean', size):
+                root, cache.elements = clean_tree_by_element(root, cache.elements)
+        if root is None:
+            cache.elements, cache.rows = {}, {}
+            root = _preview_tree(html, pres, size)
+            with timed('preview_html.serialize', size):
+                return html_extract_fragments(root)
 
+        layout, structure, styleinfo = _create_layout(root, pres, layout_strategy,
+                                                      'preview_html', size)
+        with timed('preview_html.preview', size):
+            # Rows are independent of each other, so a row that has the same
+            # content and presentation info as one in the last preview has the
+            # same preview.
+            sect_dict = dict((si.node, si) for si in structure)
+            known_nodes = dict((si.node, si) for si in structure if si.tag in PREVIEW_BLOCKDEF)
+            rows = {}
+            fragments = []
+            for content in layout.content:
+                key = _layout_key(content, sect_dict, styleinfo)
+                row_fragments = rows.get(key)
+                if row_fragments is None:
+                    row_fragments = cache.rows.get(key)
+                if row_fragments is None:
+                    row_root = ET.fromstring("<html><body></body></html>")
+                    row_root[0].extend(_preview_nodes([content], known_nodes, structure,
+                                                      styleinfo, layout_strategy))
+                    row_fragments = html_extract_fragments(row_root)
+                rows[key] = row_fragments
+                fragments.extend(row_fragments)
+            cache.rows = rows
+        return fragments
 
-def preview_html(html, pres):
-    root, structure = format_html(html, pres, return_tree=True)
-    structure2 = [si for si in structure if si.tag in PREVIEW_BLOCKDEF]
-    known_nodes = dict((si.node, si) for si in structure2)
-    _create_preview(root, structure2, known_nodes)
-    return html_extract(root)
 
-def _create_preview(node, structure, known_nodes):
+def _layout_key(content, sect_dict, styleinfo):
+    # Returns a key for a part of a Layout, which is the same for parts that
+    # have the same preview.
+    if isinstance(content, NodeContent):
+        node_html = ET.tostring(content.node)
+        si = sect_dict.get(content.node)
+        if si is None:
+            return (node_html,)
+        return (node_html, si.tag, si.name, _presinfo_key(styleinfo[si.sect_id]))
+    return (content.__class__.__name__, _presinfo_key(content.presinfo),
+            tuple(_layout_key(c, sect_dict, styleinfo) for c in content.content))
+
+
+def _presinfo_key(presinfos):
+    return tuple(sorted((pi.prestype, pi.name, pi.column_equiv) for pi in presinfos))
+
+
+def _create_preview(node, known_nodes):
     children = node.getchildren()
     if children and children[0].tag == 'body':
         children = children[0].getchildren()
     for n in children:
         if n.tag == 'div' and n not in known_nodes:
-            _create_preview(n, structure, known_nodes)
+            _create_preview(n, known_nodes)
         else:
             sect = known_nodes.get(n)
             if sect is not None and (n.tag in BLOCKDEF or n.tag == 'div'):
-                n.set('class', 'structural ' + "tag" + n.tag.lower())
-                n.tag = "div"
-                n[:] = []
-                n.text = sect.name
+                _preview_section(n, sect)
             else:
                 node.remove(n)
 
 
+def _preview_section(n, sect):
+    n.set('class', 'structural ' + "tag" + n.tag.lower())
+    n.tag = "div"
+    n[:] = []
+    n.text = sect.name
+
+
 def _sanitise_styleinfo(styleinfo, sect_ids):
     # Replace lists with sets
     out = {}
@@ -0,0 +1,151 @@
+"""
+Timing of the stages of HTML processing.
+
+Callbacks registered with add_timing_callback are called with the stage name
+(e.g. 'format_html.parse'), the duration in seconds and the size of the
+document being processed, for every stage of format_html,
+extract_presentation, preview_html and clean_html.  Timings for the current
+thread can also be collected using 'with collect_timings() as timings'.
+
+Counts are reported in the same way, using add_count_callback and
+TimingCollector.counts - for example 'clean_tree.passes', the number of
+cleaning passes clean_tree needed.
+"""
+import threading
+import time
+
+_callbacks = []
+_count_callbacks = []
+_local = threading.local()
+
+
+def add_timing_callback(callback):
+    """
+    Registers a callable to be called with (stage, duration, size) each time
+    a stage completes.
+    """
+    if callback not in _callbacks:
+        _callbacks.append(callback)
+
+
+def remove_timing_callback(callback):
+    if callback in _callbacks:
+        _callbacks.remove(callback)
+
+
+def add_count_callback(callback):
+    """
+    Registers a callable to be called with (name, value, size) each time a
+    count is reported.
+    """
+    if callback not in _count_callbacks:
+        _count_callbacks.append(callback)
+
+
+def remove_count_callback(callback):
+    if callback in _count_callbacks:
+        _count_callbacks.remove(callback)
+
+
+def count(name, value, size=None):
+    """
+    Reports a count, e.g. the number of times a loop ran, for the document of
+    the given size.
+    """
+    collectors = getattr(_local, 'collectors', None)
+    if not _count_callbacks and not collectors:
+        return
+    for callback in _count_callbacks:
+        callback(name, value, size)
+    for collector in collectors or []:
+        collector.add_count(name, value, size)
+
+
+class TimingCollector(object):
+    """
+    Records timings for stages completed in the current thread.  Use
+    collect_timings() to create one.
+    """
+    def __init__(self):
+        self.records = []
+        self.counts = []
+
+    def __call__(self, stage, duration, size):
+        self.records.append((stage, duration, size))
+
+    def add_count(self, name, value, size):
+        self.counts.append((name, value, size))
+
+    def count_totals(self):
+        """
+        Returns a list of (name, total value) in the order counts were first
+        reported.
+        """
+        return _totals(self.counts)
+
+    def totals(self):
+        """
+        Returns a list of (stage, total duration) in the order stages were
+        first completed.
+        """
+        return _totals(self.records)
+
+    def __enter__(self):
+        if not hasattr(_local, 'collectors'):
+            _local.collectors = []
+        _local.collectors.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _local.collectors.remove(self)
+
+
+def _totals(records):
+    totals = {}
+    order = []
+    for name, value, size in records:
+        if name not in totals:
+            totals[name] = 0
+            order.append(name)
+        totals[name] += value
+    return [(name, totals[name]) for name in order]
+
+
+def collect_timings():
+    return TimingCollector()
+
+
+def timed(stage, size=None):
+    """
+    Returns a context manager that times the code it contains, reporting it as
+    the named stage.  Does almost nothing if no-one is interested.
+    """
+    if not _callbacks and not getattr(_local, 'collectors', None):
+        return _null_timer
+    return _Timer(stage, size)
+
+
+class _Timer(object):
+
+    def __init__(self, stage, size):
+        self.stage = stage
+        self.size = size
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        duration = time.time() - self.start
+        for callback in _callbacks + getattr(_local, 'collectors', []):
+            callback(self.stage, duration, self.size)
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+_null_timer = _NullTimer()
@@ -4,7 +4,7 @@ from lxml import etree as ET
 
 from semanticeditor.definitions import COMMANDS, SORTED_COMMANDS, NEWROW, NEWCOL, NEWINNERROW, NEWINNERCOL, TooManyColumns, BadStructure
 from semanticeditor.common import get_classes_for_node, get_classes_from_presinfo
-from semanticeditor.utils.etree import get_parent
+from semanticeditor.utils.etree import TreeIndex
 
 
 ### Layout details ###
@@ -75,6 +75,15 @@ class LayoutDetailsBase(object):
         """
         raise NotImplementedError()
 
+    def cache_key(self):
+        """
+        Returns a string identifying this strategy and its configuration, for
+        use in keys when caching formatted HTML.
+        """
+        cls = self.__class__
+        return "%s.%s:%s:%s" % (cls.__module__, cls.__name__,
+                                self.max_columns, self.use_inner_column_div)
+
     # Hacks, optional
     def format_pre_parse_hacks(self, html, styleinfo):
         """
@@ -104,6 +113,19 @@ class LayoutDetailsBase(object):
         """
         return tree
 
+    # True if the hacks of format_post_layout_hacks only change and depend on
+    # single sections, so that previews can be built without formatting the
+    # whole document (see format_preview_hacks).
+    per_node_preview_hacks = False
+
+    def format_preview_hacks(self, node, structure, styleinfo):
+        """
+        For previews, if per_node_preview_hacks is True, applies the hacks of
+        format_post_layout_hacks to the node of a single section that is shown
+        in the preview, after its CSS classes have been applied.
+        """
+        raise NotImplementedError()
+
     def extract_pre_parse_hacks(self, html):
         """
         For extracting presentation info, applies hacks to formatted HTML before
@@ -137,6 +159,8 @@ class LayoutDetails(LayoutDetailsBase):
 
     use_inner_column_div = True
 
+    per_node_preview_hacks = True
+
     def row_classes(self, logical_column_count, actual_column_count):
         retval = [self.ROW_CLASS]
         if actual_column_count > 1:
@@ -168,29 +192,35 @@ class LayoutDetails(LayoutDetailsBase):
 
     # Hacks
     def format_post_layout_hacks(self, tree, structure, styleinfo):
-        # WYMEditor cannot insert divs. This is a workaround
         for n in tree.getiterator():
-            if n.tag == 'p' and ('div' in get_classes_for_node(n)):
-                n.tag = 'div'
-            if n.tag == 'p':
-                # If only child element is a plugin object, convert to
-                # a div.
-                # NB: current implementation of plugin objects is that they
-                # are represented by an image in the editor.  Our code has to
-                # run before these are converted, so we have to work with this
-                # implementation detail.
-                children = n.getchildren()
-                if ((n.text is None or n.text.strip() == "")
-                    and len(children) == 1
-                    and children[0].tag == "img"
-                    and (children[0].tail is None or children[0].tail.strip() == "")
-                    and children[0].attrib.get('id', '').startswith("plugin_obj")):
-                        n.tag = 'div'
-                        # Add 'div' to list of classes
-                        # This handles the reverse transform for us:
-                        n.attrib['class'] = ' '.join(n.attrib.get('class', '').split(' ') + ['div']).strip()
+            self._div_hacks(n)
         return tree
 
+    def format_preview_hacks(self, node, structure, styleinfo):
+        self._div_hacks(node)
+
+    def _div_hacks(self, n):
+        # WYMEditor cannot insert divs. This is a workaround
+        if n.tag == 'p' and ('div' in get_classes_for_node(n)):
+            n.tag = 'div'
+        if n.tag == 'p':
+            # If only child element is a plugin object, convert to
+            # a div.
+            # NB: current implementation of plugin objects is that they
+            # are represented by an image in the editor.  Our code has to
+            # run before these are converted, so we have to work with this
+            # implementation detail.
+            children = n.getchildren()
+            if ((n.text is None or n.text.strip() == "")
+                and len(children) == 1
+                and children[0].tag == "img"
+                and (children[0].tail is None or children[0].tail.strip() == "")
+                and children[0].attrib.get('id', '').startswith("plugin_obj")):
+                    n.tag = 'div'
+                    # Add 'div' to list of classes
+                    # This handles the reverse transform for us:
+                    n.attrib['class'] = ' '.join(n.attrib.get('class', '').split(' ') + ['div']).strip()
+
     def extract_post_parse_hacks(self, tree):
         # inverse part of above workaround
         for n in tree.getiterator():
@@ -212,8 +242,10 @@ class NodeContent(object):
     def __init__(self, node):
         self.node = node
 
-    def as_nodes(self, layout_strategy):
-        return [self.node]
+    def as_nodes(self, layout_strategy, node_func=None):
+        if node_func is None:
+            return [self.node]
+        return node_func(self.node)
 
 # Simple container for whole layout.
 class Layout(object):
@@ -241,9 +273,11 @@ class LayoutRow(object):
         """
         return sum(_layout_column_width(c) for c in self.content)
 
-    def as_nodes(self, layout_strategy):
+    def as_nodes(self, layout_strategy, node_func=None):
         """
-        Returns layout as a list of ElementTree nodes
+        Returns layout as a list of ElementTree nodes.  If node_func is
+        given, it is called with each node of the document in the layout, and
+        returns a list of nodes to use in its place.
         """
         # Row
         logical_column_count = self.column_count()
@@ -273,7 +307,7 @@ class LayoutRow(object):
             else:
                 contentdiv = coldiv
             for n in col.content:
-                contentdiv.extend(n.as_nodes(layout_strategy))
+                contentdiv.extend(n.as_nodes(layout_strategy, node_func))
             rowdiv.append(coldiv)
 
             logical_column_num += _layout_column_width(col)
@@ -319,6 +353,7 @@ def _find_layout_commands(root, structure, styleinfo):
     # of 'newrow_' or 'newcol_' + id of block they precede.
 
     sect_dict = dict((s.sect_id, s) for s in structure)
+    index = None
     command_info = {}
     for c in COMMANDS:
         # for each command, store a dictionary that is
@@ -331,7 +366,9 @@ def _find_layout_commands(root, structure, styleinfo):
                 real_sect_id = sect_id[len(c.prefix):]
                 sect = sect_dict.get(real_sect_id)
                 if sect is not None:
-                    parent = get_parent(root, sect.node)
+                    if index is None:
+                        index = TreeIndex(root)
+                    parent = index.get_parent(sect.node)
                     if not _is_root(parent):
                         raise BadStructure("Section \"%(name)s\" is not at the top level of the"
                                            " document, and therefore cannot have a column"
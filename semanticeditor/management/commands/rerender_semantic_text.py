@@ -0,0 +1,110 @@
+import os
+import time
+from optparse import make_option
+
+from cms.plugins.text.models import Text
+from cms.plugins.text.utils import plugin_admin_html_to_tags, plugin_tags_to_admin_html
+from cms.utils.html import clean_html
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from semanticeditor.batch import batch_reformat_html
+from semanticeditor.registry import css_class_registry
+
+
+class Command(BaseCommand):
+    help = ("Re-renders the HTML of all SemanticTextPlugin instances, so that it "
+            "reflects the current CSS classes and layout settings.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help="Don't save any changes, just report what would change."),
+        make_option('--processes', type='int', dest='processes', default=None,
+                    help="Number of worker processes (default: SEMANTICEDITOR_BATCH_PROCESSES, or number of CPUs)."),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=500,
+                    help="Number of rows to load and save at a time (default 500)."),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+                    help="File to record progress in. If the command is interrupted, "
+                    "running it again with the same file continues where it left off."),
+        )
+
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError("This command takes no arguments")
+        dry_run = options['dry_run']
+        chunk_size = options['chunk_size']
+        checkpoint = options['checkpoint']
+        verbosity = int(options['verbosity'])
+        if chunk_size < 1:
+            raise CommandError("--chunk-size must be at least 1")
+
+        classes = css_class_registry.get_class_dict()
+
+        last_pk = 0
+        if checkpoint is not None and os.path.exists(checkpoint):
+            last_pk = int(open(checkpoint).read().strip() or 0)
+            if verbosity >= 1:
+                self.stdout.write("Resuming after id %d" % last_pk)
+
+        qs = Text.objects.filter(plugin_type='SemanticTextPlugin').order_by('pk')
+        processed = changed = 0
+        errors = []
+        start = time.time()
+        while True:
+            rows = list(qs.filter(pk__gt=last_pk).values_list('pk', 'body')[:chunk_size].iterator())
+            if not rows:
+                break
+            # Plugin objects are stored as '{{ plugin_object N }}', which
+            # isn't an element, and would be wrapped in a paragraph, so the
+            # documents are formatted in the form the editor sees.
+            results = batch_reformat_html((plugin_tags_to_admin_html(body) for pk, body in rows),
+                                          classes,
+                                          processes=options['processes'])
+            updates = []
+            for result in results:
+                pk, body = rows[result.index]
+                if result.error is not None:
+                    errors.append((pk, result.error))
+                else:
+                    new_body = self.clean_body(result.value)
+                    if new_body != body:
+                        updates.append((pk, new_body))
+            if not dry_run:
+                self.save(updates)
+            processed += len(rows)
+            changed += len(updates)
+            last_pk = rows[-1][0]
+            if checkpoint is not None and not dry_run:
+                f = open(checkpoint, 'w')
+                f.write("%d\n" % last_pk)
+                f.close()
+            if verbosity >= 2:
+                self.stdout.write("Processed %d, up to id %d" % (processed, last_pk))
+
+        # Finished, so the next run should start from the beginning.
+        if checkpoint is not None and not dry_run and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+        if verbosity >= 1:
+            elapsed = time.time() - start
+            self.stdout.write("%d processed, %d %s, %d errors in %.1f seconds (%.1f per second)" %
+                              (processed, changed, "would change" if dry_run else "changed",
+                               len(errors), elapsed, processed / elapsed if elapsed > 0 else 0))
+            for pk, e in errors:
+                self.stdout.write("  Text %d: %s" % (pk, e))
+
+    def clean_body(self, html):
+        # The same as saving the plugin in the admin does: the form's body is
+        # converted by Text.body_for_admin and cleaned by Text.clean().
+        return clean_html(plugin_admin_html_to_tags(html), full=False)
+
+    def save(self, updates):
+        # Django has no bulk update of different values, so we do an UPDATE
+        # per row, with one transaction per chunk.  Text.save() is skipped:
+        # it only maintains the CMSPlugin tree, which is unchanged, and the
+        # changed date and save signals, which are for edits by users.
+        # clean_plugins() isn't needed because references to existing
+        # plugins are kept.  The body has already been through clean_body().
+        with transaction.commit_on_success():
+            for pk, body in updates:
+                Text.objects.filter(pk=pk).update(body=body)
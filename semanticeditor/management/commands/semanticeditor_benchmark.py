@@ -0,0 +1,60 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson
+
+from semanticeditor.benchmark import DOCUMENTS, STAGES, run_benchmarks, find_regressions
+
+
+class Command(BaseCommand):
+    help = ("Times each stage of HTML processing using generated documents, "
+            "optionally comparing against a baseline from a previous run.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--output', dest='output', default=None,
+                    help="File to save results to, as JSON."),
+        make_option('--baseline', dest='baseline', default=None,
+                    help="JSON file from a previous run to compare with. The command "
+                    "fails if any stage is slower by more than --threshold."),
+        make_option('--threshold', type='float', dest='threshold', default=0.2,
+                    help="Allowed slowdown compared to the baseline, as a fraction (default 0.2)."),
+        make_option('--repeat', type='int', dest='repeat', default=5,
+                    help="Number of times to run each stage (default 5)."),
+        make_option('--seed', type='int', dest='seed', default=0,
+                    help="Seed for generating documents (default 0)."),
+        )
+    args = "[document ...]"
+
+    def handle(self, *args, **options):
+        documents = list(args) or None
+        for name in args:
+            if name not in DOCUMENTS:
+                raise CommandError("Unknown document '%s', choose from: %s" %
+                                   (name, ", ".join(sorted(DOCUMENTS.keys()))))
+
+        results = run_benchmarks(documents=documents, repeat=options['repeat'],
+                                 seed=options['seed'])
+
+        for name, doc_results in sorted(results['results'].items()):
+            self.stdout.write("%s (%d bytes):" % (name, doc_results['size']))
+            for stage in STAGES:
+                t = doc_results['stages'][stage]
+                self.stdout.write("  %-22s min %8.2f ms   median %8.2f ms" %
+                                  (stage, t['min'] * 1000, t['median'] * 1000))
+
+        if options['output'] is not None:
+            f = open(options['output'], 'w')
+            simplejson.dump(results, f, indent=2, sort_keys=True)
+            f.close()
+
+        if options['baseline'] is not None:
+            f = open(options['baseline'])
+            baseline = simplejson.load(f)
+            f.close()
+            regressions = find_regressions(results, baseline, threshold=options['threshold'])
+            if regressions:
+                for name, stage, old, new in regressions:
+                    self.stdout.write("Regression: %s %s %.2f ms -> %.2f ms" %
+                                      (name, stage, old * 1000, new * 1000))
+                raise CommandError("%d stages slower than baseline" % len(regressions))
+            self.stdout.write("No regressions compared to baseline.")
@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models.signals import pre_save, post_save, post_delete
 from semanticeditor.fields import MultiSelectField
 
 # in django CMS 2.4, settings.CMS_TEMPLATE_INHERITANCE_MAGIC is unavailable
@@ -64,8 +65,56 @@ class CssClass(models.Model):
 
 def get_classes(template):
     # Can't do filter in DB easily, because 'templates' is actually a comma
-    # separated list in DB.
-    classes = CssClass.objects.all().order_by('category__name', 'verbose_name')
-    # the class is allowed in the template if explicitly mentioned, or if no templates
-    # are specified - useful, because many classes will be used across all templates  
-    return [c for c in classes if c.templates == [] or template in c.templates]
+    # separated list in DB.  So we use an index built from all the classes,
+    # which is kept up to date by the signal handlers below.
+    # The class is allowed in the template if explicitly mentioned, or if no
+    # templates are specified - useful, because many classes will be used
+    # across all templates.
+    from semanticeditor.registry import css_class_registry
+    return css_class_registry.get_css_classes(template)
+
+
+def _css_class_pre_save(sender, instance, raw=False, **kwargs):
+    # Formatted HTML depends on column_equiv, so cached results must be
+    # thrown away if it changes.
+    if raw or instance.pk is None:
+        return
+    try:
+        old = CssClass.objects.get(pk=instance.pk)
+    except CssClass.DoesNotExist:
+        return
+    if old.column_equiv != instance.column_equiv:
+        from semanticeditor.caching import invalidate_after_commit, invalidate_format_cache
+        invalidate_after_commit(invalidate_format_cache)
+
+
+def _css_class_post_delete(sender, instance, **kwargs):
+    if instance.column_equiv is not None:
+        from semanticeditor.caching import invalidate_after_commit, invalidate_format_cache
+        invalidate_after_commit(invalidate_format_cache)
+
+pre_save.connect(_css_class_pre_save, sender=CssClass)
+post_delete.connect(_css_class_post_delete, sender=CssClass)
+
+
+def _css_classes_changed(sender, **kwargs):
+    from semanticeditor.caching import invalidate_after_commit
+    from semanticeditor.registry import css_class_registry
+    invalidate_after_commit(css_class_registry.invalidate)
+
+for model in (CssClass, CssClassCategory):
+    post_save.connect(_css_classes_changed, sender=model)
+    post_delete.connect(_css_classes_changed, sender=model)
+
+
+def _pages_changed(sender, **kwargs):
+    # Any change to a page can change the templates its descendants inherit.
+    from semanticeditor.caching import invalidate_after_commit
+    from semanticeditor.registry import page_template_registry
+    invalidate_after_commit(page_template_registry.invalidate)
+
+if 'cms' in settings.INSTALLED_APPS:
+    from cms.models import Page
+    from cms.signals import page_moved
+    for signal in (post_save, post_delete, page_moved):
+        signal.connect(_pages_changed, sender=Page, dispatch_uid="semanticeditor.pages_changed")
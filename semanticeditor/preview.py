@@ -0,0 +1,148 @@
+"""
+Incremental previews for an editing session.
+
+The client sends the document as a list of top level blocks (HTML strings),
+and for each preview after the first, only the blocks and presentation info
+that have changed.  The server keeps the blocks, presentation info and the
+fragments of the last preview for each session, and returns a list that
+refers to the fragments of the last preview where they are unchanged, so that
+only new fragments are sent back to the client.  The session also keeps the
+cleaned top level elements and the preview of each row of the layout (see
+format.preview_fragments), so only the parts of the document that have
+changed are cleaned and rendered again.
+
+Sessions are held in this process, in an LRU cache whose size and timeout
+are set by SEMANTICEDITOR_PREVIEW_SESSIONS and
+SEMANTICEDITOR_PREVIEW_SESSION_TIMEOUT.  If a session has been discarded, or
+the client's idea of it is out of date, PreviewSessionExpired is raised, and
+the client must start again by sending everything.
+"""
+import threading
+import uuid
+
+from django.conf import settings
+from django.test.signals import setting_changed
+
+from semanticeditor.format import PreviewCache, preview_fragments
+from semanticeditor.utils.datastructures import LRUCache
+
+
+class PreviewSessionExpired(Exception):
+    pass
+
+
+class PreviewSession(object):
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.revision = 0
+        self.blocks = []
+        self.presentation = {}
+        self.fragments = []
+        self.cache = PreviewCache()
+        self.lock = threading.Lock()
+
+    def update(self, revision, blocks, presentation_changes, convert_pres):
+        """
+        Applies changes sent by the client and returns the changes to the
+        preview.
+
+        revision is the revision the client's changes are based on.  Each item
+        in blocks is either the HTML of a block, or the index of a block sent
+        previously that is unchanged.  presentation_changes is a dictionary of
+        section id: list of presentation info dictionaries (as produced by
+        views.PI_to_dict), or None if the section no longer has any.
+        convert_pres converts the complete presentation dictionary into the
+        form needed by format_html.
+
+        Returns a list in which each item is either the HTML of a fragment of
+        the preview, or the index of a fragment of the previous preview that
+        is unchanged.  The preview is the fragments joined together.
+
+        Raises AllUserErrors if the document can't be formatted, in which case
+        the session is unchanged.
+        """
+        with self.lock:
+            if revision != self.revision:
+                raise PreviewSessionExpired()
+            new_blocks = []
+            for b in blocks:
+                if isinstance(b, (int, long)):
+                    if not 0 <= b < len(self.blocks):
+                        raise PreviewSessionExpired()
+                    b = self.blocks[b]
+                new_blocks.append(b)
+            presentation = dict(self.presentation)
+            for sect_id, presinfo in presentation_changes.items():
+                if presinfo is None:
+                    presentation.pop(sect_id, None)
+                else:
+                    presentation[sect_id] = presinfo
+
+            if (self.revision > 0 and new_blocks == self.blocks
+                and presentation == self.presentation):
+                fragments = self.fragments
+            else:
+                fragments = preview_fragments(u"".join(new_blocks), convert_pres(presentation),
+                                              self.cache)
+
+            changes = _diff_fragments(self.fragments, fragments)
+            self.blocks = new_blocks
+            self.presentation = presentation
+            self.fragments = fragments
+            self.revision += 1
+            return changes
+
+
+def _diff_fragments(old, new):
+    # Each old fragment can be used only once, because the client reuses the
+    # DOM nodes it created for it.
+    unused = {}
+    for i, f in enumerate(old):
+        unused.setdefault(f, []).append(i)
+    for indexes in unused.values():
+        indexes.reverse()
+    changes = []
+    for f in new:
+        indexes = unused.get(f)
+        if indexes:
+            changes.append(indexes.pop())
+        else:
+            changes.append(f)
+    return changes
+
+
+class PreviewSessionStore(object):
+
+    def __init__(self, maxsize, timeout):
+        self._sessions = LRUCache(maxsize, ttl=timeout)
+
+    def create(self):
+        session = PreviewSession()
+        self._sessions.set(session.id, session)
+        return session
+
+    def get(self, session_id):
+        """
+        Returns the session with the given id, raising PreviewSessionExpired
+        if it has been discarded.
+        """
+        session = self._sessions.get(session_id)
+        if session is None:
+            raise PreviewSessionExpired()
+        return session
+
+
+def get_preview_sessions():
+    if not _sessions:
+        _sessions.append(PreviewSessionStore(getattr(settings, 'SEMANTICEDITOR_PREVIEW_SESSIONS', 100),
+                                             getattr(settings, 'SEMANTICEDITOR_PREVIEW_SESSION_TIMEOUT', 1800)))
+    return _sessions[0]
+
+_sessions = []
+
+def _setting_changed(sender, setting=None, **kwargs):
+    if setting.startswith('SEMANTICEDITOR_PREVIEW_'):
+        del _sessions[:]
+
+setting_changed.connect(_setting_changed)
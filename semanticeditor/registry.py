@@ -0,0 +1,221 @@
+"""
+Process-local copies of database information needed by the editor, so that
+requests do not need to query the database for it:
+
+ - the CssClass table, as PresentationClass objects, invalidated when
+   CssClass or CssClassCategory objects are saved or deleted (see models.py)
+
+ - the template used by each page, invalidated when pages are saved, moved or
+   deleted (see models.py)
+
+If SEMANTICEDITOR_FORMAT_CACHE is set, version numbers are kept in that cache,
+so that changes made in one process are seen by all the others.
+
+Invalidation happens again when the request finishes, after the changes have
+been committed (see caching.invalidate_after_commit).
+"""
+from datetime import datetime
+import threading
+
+from semanticeditor.caching import bump_shared_version, get_shared_cache, get_shared_version
+from semanticeditor.definitions import PresentationClass, freeze_presentation_info
+from semanticeditor.utils.datastructures import LRUCache
+
+VERSION_KEY = 'semanticeditor:cssclasses:version'
+PAGE_TEMPLATES_VERSION_KEY = 'semanticeditor:pagetemplates:version'
+
+
+def css_class_to_presentation_class(c):
+    return PresentationClass(c.name,
+                             verbose_name=c.verbose_name,
+                             description=c.description,
+                             allowed_elements=c.allowed_elements.lower().split(' '),
+                             column_equiv=c.column_equiv,
+                             category=c.category.name if c.category is not None else None)
+
+
+class CssClassRegistry(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = 0 # incremented for every local invalidation
+        self._data = None
+
+    def get_classes(self, template=None):
+        """
+        Returns a list of PresentationClass objects, ordered by category name
+        and then verbose_name.  If template is given, only classes available
+        for that template are returned.  The objects must not be changed.
+        """
+        data = self._get_data()
+        if template is None:
+            return data.classes
+        return data.for_template(template)[1]
+
+    def get_class_dict(self):
+        """
+        Returns a dictionary of PresentationClass objects keyed on name.
+        """
+        return self._get_data().class_dict
+
+    def get_css_classes(self, template):
+        """
+        Returns a list of the CssClass objects available for template, ordered
+        by category name and then verbose_name.
+        """
+        return list(self._get_data().for_template(template)[0])
+
+    def get_template_key(self, template):
+        """
+        Returns a value that is the same for all templates which have the same
+        classes available, for use as (part of) a key with memoize().
+        """
+        data = self._get_data()
+        return template if template in data.by_template else None
+
+    def memoize(self, key, func):
+        """
+        Returns the result of func(), which is kept until the class data
+        changes.  For data derived from the classes e.g. serialised lists.
+        """
+        memo = self._get_data().memo
+        try:
+            return memo[key]
+        except KeyError:
+            value = memo[key] = func()
+            return value
+
+    def last_modified(self):
+        """
+        Returns the time (a UTC datetime) that the current data was loaded.
+        """
+        return self._get_data().loaded_at
+
+    def invalidate(self):
+        """
+        Discards the current data, in this process and (if a shared cache is
+        configured) all others.
+        """
+        with self._lock:
+            self._version += 1
+            self._data = None
+        cache = get_shared_cache()
+        if cache is not None:
+            bump_shared_version(cache, VERSION_KEY)
+
+    def _get_data(self):
+        shared_version = self._get_shared_version()
+        data = self._data
+        if data is None or data.shared_version != shared_version:
+            data = self._load(shared_version)
+        return data
+
+    def _get_shared_version(self):
+        cache = get_shared_cache()
+        if cache is None:
+            return None
+        return get_shared_version(cache, VERSION_KEY)
+
+    def _load(self, shared_version):
+        from semanticeditor.models import CssClass
+        version = self._version
+        css_classes = list(CssClass.objects.select_related('category')
+                           .order_by('category__name', 'verbose_name'))
+        data = _RegistryData(shared_version, css_classes)
+        with self._lock:
+            # If invalidate() was called while we were loading, the data may
+            # already be out of date, so we don't keep it.
+            if self._version == version:
+                self._data = data
+        return data
+
+
+class _RegistryData(object):
+
+    def __init__(self, shared_version, css_classes):
+        self.shared_version = shared_version
+        self.loaded_at = datetime.utcnow().replace(microsecond=0)
+        self.memo = {}
+        self.classes = []
+        for c in css_classes:
+            pc = css_class_to_presentation_class(c)
+            freeze_presentation_info(pc)
+            self.classes.append(pc)
+        self.class_dict = dict((pc.name, pc) for pc in self.classes)
+
+        # Index of template -> (CssClass list, PresentationClass list).
+        # Classes with no templates are available in all templates, and
+        # templates not in the index only get those.
+        templates = set()
+        for c in css_classes:
+            templates.update(c.templates)
+        self.all_templates = ([], [])
+        self.by_template = dict((t, ([], [])) for t in templates)
+        for c, pc in zip(css_classes, self.classes):
+            if c.templates == []:
+                lists = [self.all_templates] + self.by_template.values()
+            else:
+                lists = [self.by_template[t] for t in c.templates]
+            for css_classes_list, classes_list in lists:
+                css_classes_list.append(c)
+                classes_list.append(pc)
+
+    def for_template(self, template):
+        return self.by_template.get(template, self.all_templates)
+
+
+css_class_registry = CssClassRegistry()
+
+
+class PageTemplateRegistry(object):
+    """
+    Caches the template used by each page.  For pages that inherit their
+    template, finding it requires queries up the page tree.
+    """
+    def __init__(self, maxsize=1000):
+        self._lock = threading.Lock()
+        self._version = 0 # incremented for every local invalidation
+        self._cache = LRUCache(maxsize)
+        self._shared_version = None
+
+    def get_template(self, page_id):
+        page_id = int(page_id)
+        shared_version = self._get_shared_version()
+        if shared_version != self._shared_version:
+            with self._lock:
+                self._cache.clear()
+                self._shared_version = shared_version
+        template = self._cache.get(page_id)
+        if template is None:
+            version = self._version
+            template = self._load(page_id)
+            with self._lock:
+                # Don't keep it if invalidate() was called while loading
+                if self._version == version:
+                    self._cache.set(page_id, template)
+        return template
+
+    def invalidate(self):
+        """
+        Discards all cached templates, in this process and (if a shared cache
+        is configured) all others.
+        """
+        with self._lock:
+            self._version += 1
+            self._cache.clear()
+        cache = get_shared_cache()
+        if cache is not None:
+            bump_shared_version(cache, PAGE_TEMPLATES_VERSION_KEY)
+
+    def _get_shared_version(self):
+        cache = get_shared_cache()
+        if cache is None:
+            return None
+        return get_shared_version(cache, PAGE_TEMPLATES_VERSION_KEY)
+
+    def _load(self, page_id):
+        from cms.models import Page
+        return Page.objects.get(pk=page_id).get_template()
+
+
+page_template_registry = PageTemplateRegistry()
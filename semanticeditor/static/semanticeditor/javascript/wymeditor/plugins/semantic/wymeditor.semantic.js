@@ -17,6 +17,11 @@ function PresentationControls(wym, opts) {
     // presentationInfo: a dictionary of { sectId : [PresentationInfo] }
     this.presentationInfo = {};
 
+    // loadedData: the data returned by separatePresentation, with the
+    // editor HTML and presentation info as they were just after loading.
+    // Used to tell the server when nothing has changed.
+    this.loadedData = null;
+
     // commands: an array of dictionaries corresponding to PresentationInfo objects
     // (PresentationCommand objects specifically)
     this.commands = new Array();
@@ -81,11 +86,16 @@ PresentationControls.prototype.setupControls = function(container) {
 
      // Initial set up
 
-    // retrieveCommands() must come before retrieveStyles(), due to use
-    // of calculateSelectors() which needs .commands to be set.
-    this.retrieveCommands(); // async=False
-    this.retrieveStyles(); // async=False
-    this.separatePresentation();
+    if (this.opts.bootstrapUrl) {
+        // Get everything in one asynchronous request.
+        this.bootstrap();
+    } else {
+        // retrieveCommands() must come before retrieveStyles(), due to use
+        // of calculateSelectors() which needs .commands to be set.
+        this.retrieveCommands(); // async=False
+        this.retrieveStyles(); // async=False
+        this.separatePresentation();
+    }
 
     this.previewButton.click(function(event) {
                                  self.showPreview();
@@ -148,23 +158,95 @@ PresentationControls.prototype.setupControls = function(container) {
               });
 };
 
+// Gets commands, styles and separated HTML/presentation in one request.
+PresentationControls.prototype.bootstrap = function() {
+    var self = this;
+    jQuery.post(this.opts.bootstrapUrl,
+                {
+                    html: self.wym.xhtml(),
+                    template: this.opts.template,
+                    page_id: this.opts.pageId
+                },
+                function(data) {
+                    self.withGoodData(data,
+                        function(value) {
+                            // Commands must be loaded before styles, see
+                            // setupControls
+                            self.loadCommands(value.commands);
+                            self.loadStyles(value.styles);
+                            if (self.restoreSubmittedPresentation()) {
+                                return;
+                            }
+                            self.withGoodData(value.separated,
+                                function(value) {
+                                    self.loadPresentation(value);
+                                });
+                        });
+                }, "json");
+};
+
 // Setup document - splits the HTML into 'content HTML' and 'presentation'
 PresentationControls.prototype.separatePresentation = function() {
+    if (this.restoreSubmittedPresentation()) {
+        return;
+    }
     var self = this;
     jQuery.post(this.opts.separatePresentationUrl, { html: self.wym.xhtml() } ,
                 function(data) {
                     self.withGoodData(data,
                         function(value) {
-                            // Store the presentation
-                            self.presentationInfo = value.presentation;
-                            // Update the HTML
-                            self.setHtml(value.html);
-                            // Update presentation of HTML
-                            self.updateAfterLoading();
+                            self.loadPresentation(value);
                         });
                 }, "json");
 };
 
+PresentationControls.prototype.loadPresentation = function(value) {
+    // Store the presentation
+    this.presentationInfo = value.presentation;
+    // Update the HTML
+    this.setHtml(value.html);
+    // Update presentation of HTML
+    this.updateAfterLoading();
+    // Remember what we loaded
+    this.prepareData();
+    this.loadedData = {
+        html: value.html,
+        fingerprint: value.fingerprint,
+        editorHtml: this.wym.xhtml(),
+        presentation: JSON.stringify(this.presentationInfo)
+    };
+};
+
+// If the form has been shown again because the HTML and presentation couldn't
+// be combined when it was saved (see fillFormFields), the editor has the HTML
+// as it was submitted, including command blocks, and the presentation info is
+// in the hidden field.  Carries on from there, returning true, rather than
+// losing the presentation info by separating the HTML again.
+PresentationControls.prototype.restoreSubmittedPresentation = function() {
+    var form = jQuery(this.wym._options.updateSelector);
+    var presentation = form.find("input[name=semantic_presentation]").val();
+    if (!presentation || form.find("input[name=semantic_fingerprint]").val()) {
+        // With a fingerprint, the original HTML was submitted, which can be
+        // separated as normal.
+        return false;
+    }
+    try {
+        presentation = JSON.parse(presentation);
+    } catch (e) {
+        return false;
+    }
+    this.presentationInfo = presentation;
+    this.updateAllStyleDisplay();
+    this.prepareData();
+    this.loadedData = {
+        html: null,
+        fingerprint: null,
+        editorHtml: this.wym.xhtml(),
+        presentation: JSON.stringify(this.presentationInfo)
+    };
+    return true;
+};
+
 PresentationControls.prototype.updateAfterLoading = function() {
     this.insertCommandBlocks();
     this.updateAllStyleDisplay();
@@ -183,24 +265,29 @@ PresentationControls.prototype.retrieveCommands = function() {
     var data = JSON.parse(res);
 
     self.withGoodData(data, function(value) {
-                            self.commands = data.value;
-                            for (var i = 0; i < self.commands.length; i++) {
-                                var c = self.commands[i];
-                                self.commandDict[c.name] = c;
-                            }
-                            self.calculateSelectors(self.commands);
-                            self.allCommandSelectors = jQuery.map(self.commands,
-                                                                    function(c, i) { return self.tagnameToSelector(c.name); }
-                                                                    ).join(",");
-                            self.buildCommandList();
-                            jQuery.each(self.commands,
-                                function(i, c) {
-                                    self.addCssRule(self.tagnameToSelector(c.name) + ":after",
-                                                    'content: "' + c.verbose_name + '"');
-                                });
+                            self.loadCommands(value);
                         });
 };
 
+PresentationControls.prototype.loadCommands = function(commands) {
+    var self = this;
+    this.commands = commands;
+    for (var i = 0; i < this.commands.length; i++) {
+        var c = this.commands[i];
+        this.commandDict[c.name] = c;
+    }
+    this.calculateSelectors(this.commands);
+    this.allCommandSelectors = jQuery.map(this.commands,
+                                          function(c, i) { return self.tagnameToSelector(c.name); }
+                                          ).join(",");
+    this.buildCommandList();
+    jQuery.each(this.commands,
+        function(i, c) {
+            self.addCssRule(self.tagnameToSelector(c.name) + ":after",
+                            'content: "' + c.verbose_name + '"');
+        });
+};
+
 PresentationControls.prototype.retrieveStyles = function() {
     var self = this;
     // Needs async=false, since separatePresentation depends on data.
@@ -217,12 +304,16 @@ PresentationControls.prototype.retrieveStyles = function() {
     var data = JSON.parse(res);
 
     self.withGoodData(data, function(value) {
-        self.availableStyles = data.value;
-        self.calculateSelectors(self.availableStyles);
-        self.buildClassList();
+        self.loadStyles(value);
     });
 };
 
+PresentationControls.prototype.loadStyles = function(styles) {
+    this.availableStyles = styles;
+    this.calculateSelectors(this.availableStyles);
+    this.buildClassList();
+};
+
 PresentationControls.prototype.calculateSelectors = function(stylelist) {
     // Given a list of styles, add a 'allowed_elements_selector' attribute
     // on the basis of the 'allowed_elements' attribute.
@@ -466,18 +557,41 @@ PresentationControls.prototype.docKeydown = function(evt) {
 };
 
 PresentationControls.prototype.formSubmit = function(event) {
+    if (this.loadedData == null) {
+        // The HTML has not been split into content and presentation yet, so
+        // it can be saved as it is.
+        return;
+    }
     this.prepareData();
+    var form = jQuery(this.wym._options.updateSelector);
+    var presentationField = form.find("input[name=semantic_presentation]");
+    if (presentationField.length > 0) {
+        // The form combines the HTML and presentation when it is saved.
+        this.fillFormFields(form, presentationField);
+        return;
+    }
+
     // Since we are in the middle of submitting the page, an asynchronous
     // request will be too late! So we block instead.
 
     // TODO - exception handling.  If this fails, the default
     // handler will post the form, causing all formatting to be lost.
+    var postData = {
+        html: this.wym.xhtml(),
+        presentation: JSON.stringify(this.presentationInfo)
+    };
+    var loaded = this.loadedData;
+    if (loaded != null && loaded.fingerprint &&
+        postData.html == loaded.editorHtml &&
+        postData.presentation == loaded.presentation) {
+        // Nothing has changed, so the server can return the original HTML
+        // without formatting it again.
+        postData.html = loaded.html;
+        postData.fingerprint = loaded.fingerprint;
+    }
     var res = jQuery.ajax({
                   type: "POST",
-                  data: {
-                      html: this.wym.xhtml(),
-                      presentation: JSON.stringify(this.presentationInfo)
-                  },
+                  data: postData,
                   url: this.opts.combinePresentationUrl,
                   dataType: "json",
                   async: false
@@ -496,6 +610,28 @@ PresentationControls.prototype.formSubmit = function(event) {
     }
 };
 
+PresentationControls.prototype.fillFormFields = function(form, presentationField) {
+    var html = this.wym.xhtml();
+    var presentation = JSON.stringify(this.presentationInfo);
+    var fingerprint = "";
+    // Make sure the textarea has the content HTML, whether or not the normal
+    // WYMeditor update has already been called.
+    this.wym.update();
+    var loaded = this.loadedData;
+    if (loaded.fingerprint &&
+        html == loaded.editorHtml &&
+        presentation == loaded.presentation) {
+        // Nothing has changed, so the server can use the original HTML
+        // without formatting it again.  If the textarea is updated again
+        // after this, the fingerprint won't match and it is formatted as
+        // normal.
+        jQuery(this.wym._element).val(loaded.html);
+        fingerprint = loaded.fingerprint;
+    }
+    presentationField.val(presentation);
+    form.find("input[name=semantic_fingerprint]").val(fingerprint);
+};
+
 PresentationControls.prototype.saveCurrentElemId = function() {
 
     // When a container tag is clicked, the tag of the current node is changed,
@@ -992,6 +1128,10 @@ PresentationControls.prototype.showError = function(message) {
 
 PresentationControls.prototype.showPreview = function() {
     this.prepareData();
+    if (this.opts.incrementalPreview) {
+        this.showIncrementalPreview();
+        return false;
+    }
     var self = this;
     jQuery.post(this.opts.previewUrl, {'html': self.wym.xhtml(),
                                        'presentation': JSON.stringify(this.presentationInfo)
@@ -999,17 +1139,116 @@ PresentationControls.prototype.showPreview = function() {
                 function(data) {
                     self.withGoodData(data,
                         function(value) {
-                            var box = self.previewBox;
-                            var pos = jQuery(self.wym._iframe).offset();
-                            box.find(".content").html(value.html);
-                            var height = box.outerHeight();
-                            box.css("top", pos.top + 20).css("left", pos.left + 20);
-                            box.show();
+                            self.previewBox.find(".content").html(value.html);
+                            self.displayPreview();
                         });
                 }, "json");
     return false;
 };
 
+PresentationControls.prototype.displayPreview = function() {
+    var box = this.previewBox;
+    var pos = jQuery(this.wym._iframe).offset();
+    box.css("top", pos.top + 20).css("left", pos.left + 20);
+    box.show();
+};
+
+// Sends only the blocks and presentation info that have changed since the
+// last preview, and gets back only the parts of the preview that changed.
+PresentationControls.prototype.showIncrementalPreview = function() {
+    var self = this;
+    var state = this.previewState;
+    var blocks = this.getBlocks();
+    var presentation = {};
+    for (var key in this.presentationInfo) {
+        presentation[key] = JSON.stringify(this.presentationInfo[key]);
+    }
+
+    var postData = {};
+    var sentBlocks = blocks;
+    var changes = this.presentationInfo;
+    if (state != null) {
+        postData.session = state.session;
+        postData.revision = state.revision;
+        // Unchanged blocks are sent as the index of the same block last time
+        var previous = {};
+        for (var i = 0; i < state.blocks.length; i++) {
+            if (previous["_" + state.blocks[i]] === undefined) {
+                previous["_" + state.blocks[i]] = i;
+            }
+        }
+        sentBlocks = jQuery.map(blocks, function(b, i) {
+                                    var idx = previous["_" + b];
+                                    return idx === undefined ? b : idx;
+                                });
+        changes = {};
+        for (var key in presentation) {
+            if (state.presentation[key] !== presentation[key]) {
+                changes[key] = this.presentationInfo[key];
+            }
+        }
+        for (var key in state.presentation) {
+            if (presentation[key] === undefined) {
+                changes[key] = null;
+            }
+        }
+    }
+    postData.blocks = JSON.stringify(sentBlocks);
+    postData.presentation = JSON.stringify(changes);
+
+    jQuery.post(this.opts.previewUrl, postData,
+                function(data) {
+                    self.withGoodData(data,
+                        function(value) {
+                            if (value.expired) {
+                                // Server has forgotten us, start again.
+                                self.previewState = null;
+                                if (state != null) {
+                                    self.showIncrementalPreview();
+                                }
+                                return;
+                            }
+                            self.previewState = {
+                                session: value.session,
+                                revision: value.revision,
+                                blocks: blocks,
+                                presentation: presentation
+                            };
+                            self.updatePreview(value.fragments);
+                            self.displayPreview();
+                        });
+                }, "json");
+};
+
+// Splits the document into top level blocks of HTML
+PresentationControls.prototype.getBlocks = function() {
+    var container = jQuery("<div></div>").html(this.wym.xhtml()).get(0);
+    var blocks = [];
+    for (var i = 0; i < container.childNodes.length; i++) {
+        var n = container.childNodes[i];
+        if (n.nodeType == 1) {
+            blocks.push(n.outerHTML);
+        } else if (n.nodeType == 3) {
+            blocks.push(this.escapeHtml(n.nodeValue));
+        }
+    }
+    return blocks;
+};
+
+// Rebuilds the preview from a list of fragments, in which numbers refer to
+// fragments of the previous preview, which are reused.
+PresentationControls.prototype.updatePreview = function(fragments) {
+    var content = this.previewBox.find(".content");
+    var old = content.children(".previewfragment").detach();
+    var nodes = jQuery.map(fragments, function(f, i) {
+                               if (typeof f == "number") {
+                                   return old.get(f);
+                               }
+                               return jQuery('<div class="previewfragment"></div>').html(f).get(0);
+                           });
+    content.empty().append(jQuery(nodes));
+};
+
 PresentationControls.prototype.showStyles = function(show) {
     if (show) {
         jQuery(this.wym._doc).find('#presmodestyles').remove();
@@ -1,14 +1,37 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+import time
+from StringIO import StringIO
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.signals import request_finished
+from django.db.models.signals import post_delete, post_save
+from django.core.urlresolvers import reverse
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import simplejson
+from django.utils.unittest import skipUnless
 from lxml import etree as ET
 
 from semanticeditor.api import extract_structure, PresentationInfo, format_html, extract_presentation, clean_html, preview_html, get_classes
-from semanticeditor.common import html_extract, parse, get_structure
-from semanticeditor.definitions import IncorrectHeadings, BadStructure, TooManyColumns, PresentationClass, NEWROW, NEWCOL, NEWINNERROW, NEWINNERCOL
+from semanticeditor import benchmark, caching, clean, format
+from semanticeditor.instrumentation import add_count_callback, add_timing_callback, remove_count_callback, remove_timing_callback, collect_timings
+from semanticeditor.batch import batch_format_html, batch_extract_presentation, batch_reformat_html
+from semanticeditor.clean import clean_tree
+from semanticeditor.common import html_extract, html_extract_fragments, parse, get_structure, SectIdAllocator, StructureItem
+from semanticeditor.definitions import AllUserErrors, COMMANDS, PREVIEW_BLOCKDEF, get_presentation_info, IncorrectHeadings, BadStructure, TooManyColumns, PresentationClass, NEWROW, NEWCOL, NEWINNERROW, NEWINNERCOL
 from semanticeditor.models import CssClass
-from semanticeditor.layout import LayoutDetails
-from semanticeditor.utils.etree import get_index, get_parent, eliminate_tag, indent
+from semanticeditor.preview import PreviewSession, PreviewSessionExpired, PreviewSessionStore
+from semanticeditor.registry import css_class_registry, PageTemplateRegistry
+from semanticeditor.layout import LayoutDetails, LayoutDetailsBase
+from semanticeditor.utils.datastructures import LRUCache
+from semanticeditor.utils.etree import get_index, get_parent, get_depth, eliminate_tag, pull_up, pull_up_all, indent, iter_with_depth, TreeIndex, flatten, TextFlattener
 
 
 PC = PresentationClass
@@ -20,6 +43,30 @@ def pretty_print(content):
     return html_extract(t)
 
 
+def best_time(func, *args):
+    """
+    Returns the best of several timings of func(*args), in seconds
+    """
+    times = []
+    for i in range(3):
+        start = time.time()
+        func(*args)
+        times.append(time.time() - start)
+    return min(times)
+
+
+# Tests of the views, the plugin and the management commands need django CMS,
+# which isn't in the default test settings.  Run them with:
+#   ./manage.py test semanticeditor --settings=test_project.settings_cms
+needs_cms = skipUnless('cms' in settings.INSTALLED_APPS, "django CMS is not installed")
+
+# The scaling tests compare timings of large documents, so they are slow and
+# can fail on a loaded machine.  Run them with SEMANTICEDITOR_SCALING_TESTS=1
+# in the environment.
+scaling_test = skipUnless(os.environ.get('SEMANTICEDITOR_SCALING_TESTS'),
+                          "SEMANTICEDITOR_SCALING_TESTS is not set")
+
+
 class TestExtractStructure(TestCase):
     def test_extract_structure(self):
         self.assertEqual([(s.level, s.sect_id, s.name, s.tag) for s in extract_structure(u"""
@@ -53,6 +100,14 @@ class TestExtractStructure(TestCase):
     def test_extract_structure_missing(self):
         self.assertEqual(extract_structure(""), [])
 
+    def test_structure_item(self):
+        si = StructureItem(level=1, sect_id="p_1", name="Test...", tag="p")
+        self.assertEqual(None, si.node)
+        self.assertEqual("<StructureItem level=1 name='Test...' node=None sect_id='p_1' tag='p'>",
+                         repr(si))
+        # Compact, without an instance dictionary
+        self.assertRaises(AttributeError, setattr, si, 'foo', 1)
+
     def test_rejects_higher_headings_later(self):
         """
         Ensures that if the first heading is e.g. h2, no h1 headings
@@ -81,6 +136,18 @@ class TestExtractStructure(TestCase):
         structure = get_structure(parse(html))
         self.assertEqual(["h1_1", "h1_4", "h1_2", "h1_3"], [s.sect_id for s in structure])
 
+    def test_sect_id_allocator(self):
+        """
+        Checks that SectIdAllocator always allocates the lowest free id
+        """
+        allocator = SectIdAllocator()
+        for sect_id in ["p_2", "p_3", "p_5", "h1_1"]:
+            allocator.reserve(sect_id)
+        self.assertEqual(["p_1", "p_4", "h1_2", "p_6", "ul_1"],
+                         [allocator.allocate(t) for t in ["p", "p", "h1", "p", "ul"]])
+        allocator.reserve("p_8")
+        self.assertEqual(["p_7", "p_9"], [allocator.allocate("p"), allocator.allocate("p")])
+
     def test_name_empty_headings(self):
         """
         Checks that we get some name for a heading with no text content
@@ -119,6 +186,25 @@ class TestPresentationInfo(TestCase):
         self.assertNotEqual(p2, p3)
         self.assertEqual(set([p1]), set([p2]))
 
+    def test_shared(self):
+        p1 = get_presentation_info('class', 'foo')
+        self.assert_(p1 is get_presentation_info('class', 'foo'))
+        self.assertEqual(PC('foo'), p1)
+        self.assert_(isinstance(p1, PresentationClass))
+        self.assert_(get_presentation_info('command', 'newrow') is NEWROW)
+        self.assertRaises(AttributeError, setattr, p1, 'column_equiv', 2)
+        # Objects that aren't shared can still be changed
+        p2 = PC('foo')
+        p2.column_equiv = 2
+        self.assertEqual(2, p2.column_equiv)
+        # Shared objects can be sent to other processes
+        self.assertEqual(p1, pickle.loads(pickle.dumps(p1)))
+        self.assertEqual(NEWROW.layout_order, pickle.loads(pickle.dumps(NEWROW, 2)).layout_order)
+
+    def test_extract_shares(self):
+        pres, html = extract_presentation('<h1 class="foo">Hello</h1><p class="foo">Test</p>')
+        self.assert_(list(pres['h1_1'])[0] is list(pres['p_1'])[0])
+
 
 class TestFormat(TestCase):
     def setUp(self):
@@ -470,6 +556,178 @@ class TestPreview(TestCase):
         formatted = preview_html(html, {})
         self.assertEqual(expected, formatted)
 
+    def full_preview_html(self, html, pres):
+        # Previews used to be created from the output of format_html, and
+        # should be exactly the same.
+        root, structure = format_html(html, pres, return_tree=True)
+        known_nodes = dict((si.node, si) for si in structure if si.tag in PREVIEW_BLOCKDEF)
+        format._create_preview(root, known_nodes)
+        return html_extract(root)
+
+    def test_same_as_format_html(self):
+        docs = [('<p class="div" id="p_1">A div</p><p id="p_2" style="color: red">Two</p>'
+                 '<p id="p_3"><img id="plugin_obj_1" src="x.png"/></p> <h1 id="h1_1">Heading</h1>'
+                 '<blockquote id="blockquote_1"><p class="div" id="p_4">Quote</p></blockquote>',
+                 {'p_2': [PresentationClass('div')],
+                  'newrow_p_1': [NEWROW], 'newcol_p_1': [NEWCOL, PresentationClass('wide')],
+                  'newcol_p_3': [NEWCOL]})]
+        for name in ['small', 'medium', 'pasted', 'flat']:
+            docs.append(benchmark.generate_document(**benchmark.DOCUMENTS[name]))
+        for html, pres in docs:
+            self.assertEqual(self.full_preview_html(html, pres), preview_html(html, pres))
+
+    def test_base_preview_hacks(self):
+        # A strategy without per_node_preview_hacks gets its
+        # format_post_layout_hacks applied to the whole tree, which they may
+        # depend on.
+        class Strategy(LayoutDetails):
+            per_node_preview_hacks = LayoutDetailsBase.per_node_preview_hacks
+
+            def format_post_layout_hacks(self, tree, structure, styleinfo):
+                if tree.find('.//blockquote') is not None:
+                    for n in tree.getiterator('p'):
+                        n.tag = 'div'
+                return tree
+        html = "<p>One</p><blockquote><p>Two</p></blockquote>"
+        old_strategy = format.get_layout_details_strategy
+        format.get_layout_details_strategy = Strategy
+        try:
+            self.assertEqual(self.full_preview_html(html, {}), preview_html(html, {}))
+            self.assertTrue('structural tagdiv' in preview_html(html, {}))
+        finally:
+            format.get_layout_details_strategy = old_strategy
+
+
+class TestIncrementalPreview(TestCase):
+
+    def setUp(self):
+        self.session = PreviewSession()
+
+    def update(self, blocks, presentation_changes=None, revision=None):
+        if revision is None:
+            revision = self.session.revision
+        return self.session.update(revision, blocks, presentation_changes or {}, lambda p: p)
+
+    def test_first_preview(self):
+        blocks = ['<h1 id="h1_1">Hello</h1>', '<p id="p_1">Para</p>', '<p id="p_2">Two</p>']
+        pres = {'newrow_p_1': [NEWROW], 'newcol_p_1': [NEWCOL], 'newcol_p_2': [NEWCOL]}
+        fragments = self.update(blocks, pres)
+        self.assertEqual(preview_html("".join(blocks), pres), "".join(fragments))
+        self.assertEqual(2, len(fragments))
+        self.assertEqual(1, self.session.revision)
+
+    def test_changes(self):
+        self.update(['<h1>Hello</h1>', '<p>Para</p>', '<p>Two</p>'])
+        # Unchanged blocks sent as indexes
+        fragments = self.update([0, '<p>Changed</p>', 2])
+        self.assertEqual([0, '<div class="structural tagp">Changed...</div>', 2], fragments)
+        # Moving a block
+        fragments = self.update([2, 0, 1])
+        self.assertEqual([2, 0, 1], fragments)
+        # No changes
+        self.assertEqual([0, 1, 2], self.update([0, 1, 2]))
+
+    def test_presentation_changes(self):
+        self.update(['<p id="p_1">One</p>', '<p id="p_2">Two</p>'])
+        pres = {'newrow_p_1': [NEWROW], 'newcol_p_1': [NEWCOL], 'newcol_p_2': [NEWCOL]}
+        fragments = self.update([0, 1], pres)
+        self.assertEqual(1, len(fragments))
+        self.assertTrue(fragments[0].startswith('<div class="row columns2">'))
+        # Removing presentation
+        fragments = self.update([0, 1], {'newrow_p_1': None, 'newcol_p_1': None, 'newcol_p_2': None})
+        self.assertEqual(['<div class="structural tagp">One...</div>',
+                          '<div class="structural tagp">Two...</div>'], fragments)
+
+    def test_out_of_date(self):
+        self.update(['<p>One</p>'])
+        self.assertRaises(PreviewSessionExpired, self.update, [0], revision=0)
+        self.assertRaises(PreviewSessionExpired, self.update, [1])
+
+    def test_user_error_leaves_session_unchanged(self):
+        self.update(['<h1>One</h1>'])
+        self.assertRaises(AllUserErrors, self.update, [0, '<h3>Bad heading</h3>'])
+        self.assertEqual(1, self.session.revision)
+        self.assertEqual([0], self.update([0]))
+
+    def test_store(self):
+        now = [0]
+        store = PreviewSessionStore(2, 60)
+        store._sessions._timer = lambda: now[0]
+        session = store.create()
+        self.assertTrue(store.get(session.id) is session)
+        now[0] = 61
+        self.assertRaises(PreviewSessionExpired, store.get, session.id)
+
+    def resolve(self, fragments):
+        # Does what the client does with the fragments returned
+        self.fragments = [self.fragments[f] if isinstance(f, int) else f
+                          for f in fragments]
+        return "".join(self.fragments)
+
+    def test_same_as_preview_html(self):
+        # Documents that can and can't be cleaned element by element
+        docs = [('<p id="p_1">One</p> <span><p id="p_1">Two</p></span><p></p>'
+                 '<p id="p_2">Three</p>\n',
+                 {'newrow_p_2': [NEWROW]}),
+                ('Text<p id="p_1">One</p> <br/><p>Two</p><style>x</style> '
+                 '<span><p id="p_1">Three</p></span><p></p><p id="p_2">Four</p>',
+                 {'newrow_p_1': [NEWROW]}),
+                ('<p id="p_1">one</p><span>pasted</span><p id="p_2">two</p><p id="p_3">three</p>',
+                 {'newrow_p_1': [NEWROW], 'newcol_p_2': [NEWCOL]})]
+        for name in ['small', 'medium', 'pasted', 'flat']:
+            docs.append(benchmark.generate_document(**benchmark.DOCUMENTS[name]))
+        for html, pres in docs:
+            self.session = PreviewSession()
+            self.fragments = []
+            blocks = html_extract_fragments(parse(html))
+            self.assertEqual(preview_html("".join(blocks), pres),
+                             self.resolve(self.update(blocks, pres)))
+            sect_ids = [si.sect_id for si in get_structure(parse(html))
+                        if si.node.getparent().tag == 'body']
+            for i in range(0, len(blocks), max(1, len(blocks) // 10)):
+                # Change a block, and the presentation of a section
+                blocks[i] = blocks[i].replace('>', '>Changed ', 1)
+                sect_id = sect_ids[i % len(sect_ids)]
+                if i % 2:
+                    sect_id = 'newrow_' + sect_id
+                changes = {sect_id: [PC("foo")] if pres.get(sect_id) is None else None}
+                pres = dict(pres, **changes)
+                pres = dict((k, v) for k, v in pres.items() if v is not None)
+                try:
+                    expected = preview_html("".join(blocks), pres)
+                except AllUserErrors:
+                    self.assertRaises(AllUserErrors, self.update, blocks, changes)
+                    pres = self.session.presentation
+                else:
+                    self.assertEqual(expected, self.resolve(self.update(blocks, changes)))
+
+    def test_only_changes_rendered(self):
+        calls = []
+        def callback(name, value, size):
+            calls.append(name)
+        html, pres = benchmark.generate_document(**benchmark.DOCUMENTS['medium'])
+        blocks = html_extract_fragments(parse(html))
+        self.update(blocks, pres)
+        old_preview_nodes = format._preview_nodes
+        def _preview_nodes(*args):
+            calls.append('render')
+            return old_preview_nodes(*args)
+        format._preview_nodes = _preview_nodes
+        add_count_callback(callback)
+        try:
+            self.update(blocks[0:10] + ['<p>Changed</p>'] + blocks[11:])
+        finally:
+            format._preview_nodes = old_preview_nodes
+            remove_count_callback(callback)
+        # One block cleaned and one row rendered
+        self.assertEqual(['clean_tree.passes', 'render'], calls)
+
+    def test_fragments(self):
+        root = parse('Text<p>One</p> <p>Two</p>')
+        fragments = html_extract_fragments(root)
+        self.assertEqual(['Text', '<p>One</p> ', '<p>Two</p>'], fragments)
+        self.assertEqual(html_extract(root), "".join(fragments))
+
 class TestHacks(TestCase):
     def test_div_format_hack(self):
         """
@@ -532,6 +790,103 @@ class TestElementTreeUtils(TestCase):
         p = get_parent(t, n)
         self.assertEqual(1, get_index(p, n))
 
+    def test_html_extract(self):
+        t = parse(u" Caf\xe9 <p title='a\rb'>Line\r\nbreak</p> <p>&amp;</p>")
+        self.assertEqual(' Caf&#233; <p title="a\rb">Line\r\nbreak</p> <p>&amp;</p>',
+                         html_extract(t))
+        self.assertEqual(' Caf\xc3\xa9 <p title="a\rb">Line\r\nbreak</p> <p>&amp;</p>',
+                         html_extract(t, encoding='utf-8'))
+        self.assertEqual(' Caf\xe9 <p title="a\rb">Line\r\nbreak</p> <p>&amp;</p>',
+                         html_extract(t, encoding='iso-8859-1'))
+        self.assertRaises(ValueError, html_extract, t, encoding='utf-16')
+        self.assertEqual('', html_extract(parse('')))
+
+    def test_iter_with_depth(self):
+        """
+        Tests that iter_with_depth visits nodes in document order, with the
+        same depths as get_depth
+        """
+        t = parse("<h1>A</h1><blockquote><p>B <b>C</b></p><ul><li>D</li></ul></blockquote>")
+        nodes = list(iter_with_depth(t))
+        self.assertEqual([n for n, d in nodes], list(t.getiterator()))
+        for n, d in nodes:
+            self.assertEqual(get_depth(t, n), d)
+
+    def assertIndexCorrect(self, index, t):
+        for n in t.getiterator():
+            self.assertEqual(get_depth(t, n), index.get_depth(n))
+            p = get_parent(t, n)
+            self.assertEqual(p, index.get_parent(n))
+            if p is not None:
+                self.assertEqual(get_index(p, n), index.get_index(n))
+
+    def test_tree_index(self):
+        t = parse("<p>A <span>B <b>C</b> D</span> <i>E</i></p><ul><li>F</li></ul>")
+        self.assertIndexCorrect(TreeIndex(t), t)
+
+    def test_tree_index_eliminate_tag(self):
+        """
+        Tests that TreeIndex is kept up to date by eliminate_tag
+        """
+        t = parse("<p>A <span>B <span><b>C</b></span> D</span> <i>E</i></p>")
+        index = TreeIndex(t)
+        for n in t.findall(".//span"):
+            index.eliminate_tag(index.get_parent(n), index.get_index(n))
+        self.assertEqual("<p>A B <b>C</b> D <i>E</i></p>", html_extract(t))
+        self.assertIndexCorrect(index, t)
+
+    def test_flatten(self):
+        t = parse("<p>A <b>B <i>C</i> D</b> <!--E--> F</p>")
+        self.assertEqual("A B C D E F", flatten(t.find(".//p")))
+
+    def test_text_flattener_limit(self):
+        """
+        Tests that TextFlattener stops early when given a limit, but
+        returns at least as much text as asked for.
+        """
+        t = parse("<ul><li>One</li><li>Two <b>2</b></li><li>Three</li></ul>")
+        ul = t.find(".//ul")
+        flattener = TextFlattener()
+        self.assertEqual("OneTwo ", flattener.flatten(ul, 4))
+        self.assertEqual("OneTwo 2Three", flattener.flatten(ul, 13))
+        self.assertEqual("OneTwo 2Three", flattener.flatten(ul))
+        for li in ul:
+            self.assertEqual(flatten(li), flattener.flatten(li, 2))
+
+    def test_pull_up_all(self):
+        t = ET.fromstring("<a>Hello<b>Good<x>b<b>y</b></x><y>y</y>e</b>And<b>Stuff</b>End</a>")
+        pull_up_all(t.findall(".//b"))
+        self.assertEqual("<a>HelloGood<x>by</x><y>y</y>eAndStuffEnd</a>", ET.tostring(t))
+
+    def test_pull_up_all_same_as_eliminate_tag(self):
+        for html in ["<a>Hello<b>Goodbye</b>End</a>",
+                     "<a>Hello<b>First <c>node</c></b>tail<b>Good<x>b</x><y>y</y>e</b>And<b>Stuff</b></a>",
+                     "<a><b>One</b><b>Two<c/></b>Three</a>",
+                     "<a>Hello<b></b>tail<c></c>End<b/>x<i></i></a>"]:
+            t1 = ET.fromstring(html)
+            t2 = ET.fromstring(html)
+            for i, n in reversed(list(enumerate(t1))):
+                if n.tag == 'b':
+                    eliminate_tag(t1, i)
+            pull_up_all(list(reversed(t2.findall("b"))))
+            self.assertEqual(ET.tostring(t1), ET.tostring(t2))
+
+    def test_pull_up_all_same_as_pull_up(self):
+        # The tail of an element with no children goes into the text of the
+        # next sibling, and text that is joined is never None afterwards.
+        for html in ["<a>Hello<b></b>tail<c>C</c>End</a>",
+                     "<a>Hello<b>Good<x>b<b>y</b></x><b/>z<y>y</y>e</b>And<b></b><i></i></a>",
+                     "<a><b><b></b>x<c/></b><c></c></a>"]:
+            t1 = ET.fromstring(html)
+            t2 = ET.fromstring(html)
+            for n in t1.findall(".//b"):
+                pull_up(n)
+            pull_up_all(t2.findall(".//b"))
+            self.assertEqual(ET.tostring(t1), ET.tostring(t2))
+        t = ET.fromstring("<a>Hello<c/><b></b>tail<c>C</c></a>")
+        pull_up_all(t.findall("b"))
+        self.assertEqual("<a>Hello<c/><c>tailC</c></a>", ET.tostring(t))
+
     def test_eliminate_tag_1(self):
         t = ET.fromstring("<a>Hello<b>Goodbye</b>End</a>")
         eliminate_tag(t, 0)
@@ -894,6 +1249,598 @@ class TestHtmlCleanup(TestCase):
                               u'<p> Frapp&#233; </p>')
 
 
+    def test_disallowed_elements_setting(self):
+        html = "<p>Some <span>plain</span> and <em>emphasised</em> text</p>"
+        self.assertEqualClean(html, "<p>Some plain and <em>emphasised</em> text</p>")
+        with override_settings(SEMANTICEDITOR_DISALLOWED_ELEMENTS=['span', 'em']):
+            self.assertEqualClean(html, "<p>Some plain and emphasised text</p>")
+        self.assertEqualClean(html, "<p>Some plain and <em>emphasised</em> text</p>")
+
+    def test_clean_passes(self):
+        """
+        Checks that clean_tree stops as soon as a pass changes nothing, and
+        reports how many passes it used.
+        """
+        self.assertEqual(1, clean_tree(parse("<p>Clean already</p>")))
+        # Removing the table leaves text at the top level, which needs a second
+        # pass to fix, and then a third pass changes nothing.
+        t = parse("<table><tr><td>Cell</td></tr></table>")
+        self.assertEqual(3, clean_tree(t))
+        self.assertEqual("<p>Cell</p>", html_extract(t))
+
+    def test_clean_passes_reported(self):
+        counts = []
+        def callback(name, value, size):
+            counts.append((name, value))
+        add_count_callback(callback)
+        try:
+            clean_html("<table><tr><td>Cell</td></tr></table>")
+        finally:
+            remove_count_callback(callback)
+        self.assertEqual([('clean_tree.passes', 3)], counts)
+
+        with collect_timings() as timings:
+            format_html("<p>Clean already</p>", {})
+            format_html("<table><tr><td>Cell</td></tr></table>", {})
+        self.assertEqual([('clean_tree.passes', 4)], timings.count_totals())
+
+    def test_clean_tree_by_element(self):
+        html = ('<p id="p_1">One</p> <span><p id="p_1">Two</p></span>'
+                '<div><p>Three</p></div><p></p><p id="p_2">Four</p>\n')
+        root, cache = clean.clean_tree_by_element(parse(html), {})
+        self.assertEqual(clean_html(html), html_extract(root))
+        self.assertEqual(5, len(cache))
+        # Cached elements are reused
+        cache['<p/>'] = (ET.fromstring('<p>Cached</p>'),)
+        root, cache = clean.clean_tree_by_element(parse(html), cache)
+        self.assertTrue('Cached' in html_extract(root))
+        self.assertEqual(5, len(cache))
+        # Elements that affect their neighbours when cleaned
+        for html in ['Text<p>One</p>', '<p>One</p><br/>', '<p>One</p><span><br/></span>',
+                     '<p>One</p><style>x</style>', '<p>One</p>Text', '<p id="p_1"></p><p id="p_1">x</p>']:
+            self.assertEqual((None, None), clean.clean_tree_by_element(parse(html), {}))
+
+    def test_clean_max_passes(self):
+        t = parse("<table><tr><td>Cell</td></tr></table>")
+        self.assertEqual(1, clean_tree(t, max_passes=1))
+        self.assertEqual("Cell", html_extract(t))
+
+
+    def test_clean_html_cache(self):
+        html = "<p>Some <span>text</span></p>"
+        with override_settings(SEMANTICEDITOR_CLEAN_HTML_CACHE_SIZE=2):
+            cache = clean.clean_html_cache
+            self.assertEqual("<p>Some text</p>", clean_html(html))
+            self.assertEqual("<p>Some text</p>", clean_html(html))
+            self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+            # Changing settings invalidates the cache
+            with override_settings(SEMANTICEDITOR_DISALLOWED_ELEMENTS=[]):
+                self.assertEqual("<p>Some <span>text</span></p>", clean_html(html))
+            self.assertEqual("<p>Some text</p>", clean_html(html))
+        self.assertEqual(None, clean.clean_html_cache)
+
+
+class TestLRUCache(TestCase):
+    def test_eviction(self):
+        c = LRUCache(2)
+        c.set('a', 1)
+        c.set('b', 2)
+        self.assertEqual(1, c.get('a'))
+        c.set('c', 3)
+        # 'b' was least recently used
+        self.assertEqual(None, c.get('b'))
+        self.assertEqual(1, c.get('a'))
+        self.assertEqual(3, c.get('c'))
+        self.assertEqual((3, 1), (c.hits, c.misses))
+        self.assertEqual(2, len(c))
+
+    def test_ttl(self):
+        now = [0]
+        c = LRUCache(10, ttl=60, timer=lambda: now[0])
+        c.set('a', 1)
+        c.set('b', 2)
+        now[0] = 50
+        self.assertEqual(1, c.get('a'))
+        now[0] = 100
+        # 'a' was used recently, 'b' was not
+        self.assertEqual(1, c.get('a'))
+        self.assertEqual(None, c.get('b'))
+        now[0] = 200
+        c.set('c', 3)
+        # Expired items are discarded when others are added
+        self.assertEqual(1, len(c))
+
+
+class TestFormatCache(TestCase):
+
+    def setUp(self):
+        self.calls = []
+        def counting_format_html(*args, **kwargs):
+            self.calls.append(args)
+            return format_html(*args, **kwargs)
+        self._orig_format_html = caching.format_html
+        caching.format_html = counting_format_html
+
+    def tearDown(self):
+        caching.format_html = self._orig_format_html
+
+    def test_no_cache(self):
+        html = "<p>Test</p>"
+        caching.format_html_cached(html, {})
+        caching.format_html_cached(html, {})
+        self.assertEqual(2, len(self.calls))
+
+    def test_cache(self):
+        html = "<h1>Hello</h1><p>Test</p>"
+        with override_settings(SEMANTICEDITOR_FORMAT_CACHE='default'):
+            caching.invalidate_format_cache()
+            out = caching.format_html_cached(html, {'h1_1': [PC("foo")]})
+            self.assertEqual(format_html(html, {'h1_1': [PC("foo")]}), out)
+            # Equivalent style info hits the cache
+            caching.format_html_cached(html, {'h1_1': [PC("foo"), PC("foo")],
+                                              'p_1': []})
+            self.assertEqual(1, len(self.calls))
+            caching.format_html_cached(html, {'h1_1': [PC("bar")]})
+            caching.format_html_cached(html, {'h1_1': [PC("foo")]}, pretty_print=True)
+            self.assertEqual(3, len(self.calls))
+
+    def test_user_errors_not_cached(self):
+        html = "<h1>Hello</h1><h3>Bad</h3>"
+        with override_settings(SEMANTICEDITOR_FORMAT_CACHE='default'):
+            self.assertRaises(IncorrectHeadings, caching.format_html_cached, html, {})
+            self.assertRaises(IncorrectHeadings, caching.format_html_cached, html, {})
+            self.assertEqual(2, len(self.calls))
+
+    def test_column_equiv_change_invalidates(self):
+        html = "<p>Test</p>"
+        with override_settings(SEMANTICEDITOR_FORMAT_CACHE='default'):
+            c = CssClass.objects.create(name="wide", verbose_name="Wide")
+            caching.format_html_cached(html, {})
+            c.description = "Wide column"
+            c.save()
+            caching.format_html_cached(html, {})
+            self.assertEqual(1, len(self.calls))
+            c.column_equiv = 2
+            c.save()
+            caching.format_html_cached(html, {})
+            self.assertEqual(2, len(self.calls))
+            c.delete()
+            caching.format_html_cached(html, {})
+            self.assertEqual(3, len(self.calls))
+
+
+class TestRoundTrip(TestCase):
+
+    html = ('<div class="row"><div class="col"><h1 class="important">Hello</h1>'
+            '<p>Test</p></div></div>')
+
+    def setUp(self):
+        self.calls = []
+        def counting_format_html(*args, **kwargs):
+            self.calls.append(args)
+            return format_html(*args, **kwargs)
+        self._orig_format_html = caching.format_html
+        caching.format_html = counting_format_html
+
+    def tearDown(self):
+        caching.format_html = self._orig_format_html
+
+    def test_unchanged(self):
+        pres, html, fingerprint = extract_presentation(self.html, return_fingerprint=True)
+        # Simulate round trip via client, where presentation info is rebuilt
+        pres = dict((k, list(v)) for k, v in pres.items())
+        out = caching.format_html_cached(html, pres, pretty_print=True, fingerprint=fingerprint)
+        self.assertEqual(self.html, out)
+        self.assertEqual(0, len(self.calls))
+
+    def test_changed(self):
+        pres, html, fingerprint = extract_presentation(self.html, return_fingerprint=True)
+        pres2 = dict(pres)
+        pres2['h1_1'] = set()
+        out = caching.format_html_cached(html, pres2, fingerprint=fingerprint)
+        self.assertEqual(1, len(self.calls))
+        self.assert_('important' not in out)
+
+        out = caching.format_html_cached(html.replace("Test", "Changed"), pres,
+                                         fingerprint=fingerprint)
+        self.assertEqual(2, len(self.calls))
+        self.assert_('Changed' in out)
+
+    def test_bad_fingerprint(self):
+        pres, html = extract_presentation(self.html)
+        caching.format_html_cached(html, pres, fingerprint="nonsense")
+        self.assertEqual(1, len(self.calls))
+
+    def test_shared_cache(self):
+        with override_settings(SEMANTICEDITOR_FORMAT_CACHE='default'):
+            pres, html, fingerprint = extract_presentation(self.html, return_fingerprint=True)
+            out = caching.format_html_cached(html, pres, fingerprint=fingerprint)
+            self.assertEqual(self.html, out)
+            self.assertEqual(0, len(self.calls))
+
+
+class TestBatch(TestCase):
+
+    docs = [("<h1>One</h1><p>Para</p>", {'h1_1': [PC("foo")]}),
+            ("<h1>Two</h1><h3>Bad</h3>", {}),
+            ("<p>Three</p>", {'p_1': [NEWROW], 'newrow_p_1': [PC("bar")]}),
+            ]
+
+    def _check_format(self, results):
+        self.assertEqual([0, 1, 2], sorted(r.index for r in results))
+        for r in results:
+            if r.index == 1:
+                self.assertEqual(None, r.value)
+                self.assertEqual(IncorrectHeadings, r.error.__class__)
+            else:
+                self.assertEqual(None, r.error)
+                self.assertEqual(format_html(*self.docs[r.index]), r.value)
+
+    def test_format_inline(self):
+        results = list(batch_format_html(self.docs, processes=1))
+        self.assertEqual([0, 1, 2], [r.index for r in results])
+        self._check_format(results)
+
+    def test_format_pool(self):
+        results = list(batch_format_html(self.docs * 5, processes=2, chunksize=2))
+        self.assertEqual(range(15), [r.index for r in results])
+        self._check_format(results[0:3])
+        self._check_format(list(batch_format_html(self.docs, processes=2, ordered=False)))
+
+    def test_extract(self):
+        docs = [format_html(*self.docs[0]), "<h1>Two</h1><h3>Bad</h3>"]
+        results = list(batch_extract_presentation(docs, processes=2))
+        self.assertEqual(extract_presentation(docs[0]), results[0].value)
+        # extract_presentation doesn't check headings
+        self.assertEqual(None, results[1].error)
+
+    def test_reformat(self):
+        docs = [format_html("<h1>One</h1><p>Para</p>", {'h1_1': [PC("foo")], 'p_1': [PC("bar")]}),
+                "<h1>Two</h1><h3>Bad</h3>"]
+        results = list(batch_reformat_html(docs, {'foo': PC("foo")}, processes=2))
+        # Unknown classes are removed
+        self.assertEqual(format_html("<h1>One</h1><p>Para</p>", {'h1_1': [PC("foo")]},
+                                     pretty_print=True),
+                         results[0].value)
+        self.assertEqual(IncorrectHeadings, results[1].error.__class__)
+
+    def test_reformat_different_classes(self):
+        html = format_html("<h1>One</h1>", {'h1_1': [PC("foo"), PC("bar")]})
+        for processes in [1, 2]:
+            foo = batch_reformat_html([html, html], {'foo': PC("foo")}, processes=processes)
+            bar = batch_reformat_html([html, html], {'bar': PC("bar")}, processes=processes)
+            # Interleaved batches each use their own classes
+            for i in range(2):
+                self.assertTrue('"foo"' in foo.next().value)
+                self.assertTrue('"bar"' in bar.next().value)
+
+    def test_reformat_changed_classes(self):
+        html = format_html("<h1>One</h1><h1>Two</h1>",
+                           {'newrow_h1_1': [NEWROW],
+                            'newcol_h1_1': [NEWCOL, PC('wide', column_equiv=2)],
+                            'newcol_h1_2': [NEWCOL]})
+        for processes in [1, 2]:
+            for column_equiv, columns in [(2, 'columns3'), (1, 'columns2'), (2, 'columns3')]:
+                # Classes that are equal, but have a different column_equiv
+                # from the last batch
+                classes = {'wide': PC('wide', column_equiv=column_equiv)}
+                results = list(batch_reformat_html([html, html], classes, processes=processes))
+                for r in results:
+                    self.assertTrue(columns in r.value, r.value)
+
+
+@needs_cms
+class TestViews(TestCase):
+    fixtures = ['test_classes.json']
+    template = 'cms_harness/example.html'
+
+    def setUp(self):
+        css_class_registry.invalidate()
+
+    def get_json(self, response):
+        self.assertEqual(200, response.status_code)
+        return simplejson.loads(response.content)
+
+    def check_conditional(self, url, last_modified=True):
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        self.assertTrue('no-cache' in response['Cache-Control'])
+        etag = response['ETag']
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        self.assertEqual('', response.content)
+        self.assertTrue('no-cache' in response['Cache-Control'])
+        if last_modified:
+            response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=self.client.get(url)['Last-Modified'])
+            self.assertEqual(304, response.status_code)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(200, response.status_code)
+        return etag
+
+    def test_retrieve_styles(self):
+        url = reverse('semantic.retrieve_styles') + '?template=' + self.template
+        etag = self.check_conditional(url)
+        value = self.get_json(self.client.get(url))['value']
+        self.assertEqual([c.name for c in get_classes(self.template)], [d['name'] for d in value])
+
+        # Changing the classes changes the ETag
+        c = CssClass.objects.all()[0]
+        c.verbose_name = "Changed"
+        c.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+
+    def test_retrieve_commands(self):
+        url = reverse('semantic.retrieve_commands')
+        # The ETag depends only on the commands, so it is the same in every
+        # process, unlike a modification time.
+        self.check_conditional(url, last_modified=False)
+        self.assertFalse(self.client.get(url).has_header('Last-Modified'))
+        self.assertEqual('"%s"' % hashlib.sha1(self.client.get(url).content).hexdigest(),
+                         self.client.get(url)['ETag'])
+        value = self.get_json(self.client.get(url))['value']
+        self.assertEqual([c.name for c in COMMANDS], [d['name'] for d in value])
+
+    def test_bootstrap(self):
+        html = '<h1>Heading</h1><p class="myclass">Para</p>'
+        data = self.get_json(self.client.post(reverse('semantic.bootstrap'),
+                                              {'template': self.template, 'html': html}))
+        self.assertEqual('ok', data['result'])
+        value = data['value']
+        self.assertEqual(['commands', 'separated', 'styles'], sorted(value.keys()))
+        self.assertEqual(simplejson.loads(self.client.get(reverse('semantic.retrieve_commands')).content)['value'],
+                         value['commands'])
+        self.assertEqual(simplejson.loads(self.client.get(reverse('semantic.retrieve_styles') +
+                                                          '?template=' + self.template).content)['value'],
+                         value['styles'])
+        separated = self.get_json(self.client.post(reverse('semantic.separate_presentation'),
+                                                   {'html': html}))
+        self.assertEqual(separated, value['separated'])
+
+    def test_bootstrap_user_error(self):
+        # A user error in the HTML is reported in 'separated', and the rest
+        # of the response is still usable.
+        from semanticeditor import views
+        def extract_presentation(html, return_fingerprint=False):
+            raise IncorrectHeadings("Bad headings")
+        old_extract_presentation = views.extract_presentation
+        views.extract_presentation = extract_presentation
+        try:
+            data = self.get_json(self.client.post(reverse('semantic.bootstrap'),
+                                                  {'template': self.template, 'html': '<p>Para</p>'}))
+        finally:
+            views.extract_presentation = old_extract_presentation
+        self.assertEqual('ok', data['result'])
+        self.assertEqual({'result': 'usererror', 'message': 'Bad headings'},
+                         data['value']['separated'])
+        self.assertEqual(len(COMMANDS), len(data['value']['commands']))
+
+    def test_bootstrap_bad_page_id(self):
+        from semanticeditor.views import TEMPLATE_INHERITANCE_MAGIC
+        data = self.get_json(self.client.post(reverse('semantic.bootstrap'),
+                                              {'template': TEMPLATE_INHERITANCE_MAGIC,
+                                               'page_id': '12345',
+                                               'html': '<p>Para</p>'}))
+        self.assertEqual('error', data['result'])
+
+    def test_incremental_preview(self):
+        url = reverse('semantic.preview')
+        data = self.get_json(self.client.post(url, {'blocks': simplejson.dumps(['<p>One</p>'])}))
+        self.assertEqual('ok', data['result'])
+        value = data['value']
+        self.assertEqual(1, value['revision'])
+        data = self.get_json(self.client.post(url, {'blocks': simplejson.dumps([0, '<p>Two</p>']),
+                                                    'session': value['session'],
+                                                    'revision': value['revision']}))
+        self.assertEqual([0, '<div class="structural tagp">Two...</div>'],
+                         data['value']['fragments'])
+
+        # Malformed requests are user errors, not internal errors
+        for bad in [{'revision': 'x'},
+                    {'blocks': '[0'},
+                    {'blocks': simplejson.dumps({'0': '<p>One</p>'})},
+                    {'blocks': simplejson.dumps([['<p>One</p>']])},
+                    {'blocks': simplejson.dumps([True])},
+                    {'presentation': simplejson.dumps({'p_1': 'newrow'})}]:
+            post = {'blocks': simplejson.dumps([0]),
+                    'session': value['session'],
+                    'revision': 2}
+            post.update(bad)
+            data = self.get_json(self.client.post(url, post))
+            self.assertEqual('usererror', data['result'], bad)
+        # and leave the session as it was
+        data = self.get_json(self.client.post(url, {'blocks': simplejson.dumps([1]),
+                                                    'session': value['session'],
+                                                    'revision': 2}))
+        self.assertEqual([1], data['value']['fragments'])
+
+    def test_server_timing(self):
+        url = reverse('semantic.separate_presentation')
+        html = '<h1>Heading</h1><p>Para</p>'
+        response = self.client.post(url, {'html': html})
+        self.assertFalse(response.has_header('Server-Timing'))
+
+        with override_settings(SEMANTICEDITOR_SERVER_TIMING=True):
+            response = self.client.post(url, {'html': html})
+        self.assertEqual('ok', simplejson.loads(response.content)['result'])
+        stages = [s.split(';')[0] for s in response['Server-Timing'].split(', ')]
+        self.assertTrue('extract_presentation' in stages)
+        self.assertTrue('extract_presentation.parse' in stages)
+        self.assertTrue('extract_presentation;dur=' in response['Server-Timing'])
+
+
+@needs_cms
+class TestSemanticTextPluginForm(TestCase):
+
+    html = '<h1 id="h1_1">Heading</h1><p id="p_1">Para</p>'
+    presentation = {'newrow_p_1': [{'prestype': 'command', 'name': 'newrow'}]}
+
+    def get_form(self, body, presentation):
+        from semanticeditor.cms_plugins import SemanticTextPluginForm
+        return SemanticTextPluginForm(data={'body': body, 'semantic_presentation': presentation})
+
+    def test_combine(self):
+        form = self.get_form(self.html, simplejson.dumps(self.presentation))
+        self.assertTrue(form.is_valid())
+        self.assertEqual(format_html(self.html, {'newrow_p_1': [NEWROW]}, pretty_print=True),
+                         form.cleaned_data['body'])
+
+    def test_user_error(self):
+        form = self.get_form('<h1>One</h1><h3>Bad</h3>', '{}')
+        self.assertFalse(form.is_valid())
+        self.assertTrue('H3' in form.non_field_errors()[0])
+
+    def test_bad_presentation(self):
+        for presentation in ['{', '[]']:
+            form = self.get_form(self.html, presentation)
+            self.assertFalse(form.is_valid())
+            self.assertEqual(["Layout and styles could not be read, please try again."],
+                             form.non_field_errors())
+
+    def test_no_presentation(self):
+        # The body is saved as it is
+        form = self.get_form('<h1>One</h1><h3>Bad</h3>', '')
+        self.assertTrue(form.is_valid())
+        self.assertEqual('<h1>One</h1><h3>Bad</h3>', form.cleaned_data['body'])
+
+
+@needs_cms
+class TestRerenderCommand(TestCase):
+
+    def setUp(self):
+        from cms.models import Placeholder
+        css_class_registry.invalidate()
+        self.placeholder = Placeholder.objects.create(slot='main')
+        self.texts = [self.create_text(format_html(html, {'h1_1': [PC("old")]}, pretty_print=True))
+                      for html in ["<h1>One</h1>", "<h1>Two</h1>"]]
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def create_text(self, body, plugin_type='SemanticTextPlugin', parent=None):
+        from cms.plugins.text.models import Text
+        return Text.objects.create(placeholder=self.placeholder, plugin_type=plugin_type,
+                                   parent=parent, language='en', position=0, body=body)
+
+    def get_body(self, text):
+        return text.__class__.objects.get(pk=text.pk).body
+
+    def rerender(self, **options):
+        out = StringIO()
+        call_command('rerender_semantic_text', processes=1, stdout=out, **options)
+        return out.getvalue()
+
+    def test_rerender(self):
+        out = self.rerender()
+        self.assertTrue(out.startswith("2 processed, 2 changed, 0 errors"))
+        for text in self.texts:
+            self.assertTrue('class="old"' not in self.get_body(text))
+        # Running again changes nothing
+        self.assertTrue(self.rerender().startswith("2 processed, 0 changed, 0 errors"))
+
+    def test_plugin_objects(self):
+        text = self.create_text("")
+        child = self.create_text("child", plugin_type='TextPlugin', parent=text)
+        body = '<div class="div"> {{ plugin_object %d }} </div>' % child.pk
+        text.body = body
+        text.save()
+        self.rerender()
+        self.assertEqual(body, " ".join(self.get_body(text).split()))
+
+    def test_dry_run(self):
+        out = self.rerender(dry_run=True)
+        self.assertTrue(out.startswith("2 processed, 2 would change, 0 errors"))
+        for text in self.texts:
+            self.assertTrue('class="old"' in self.get_body(text))
+
+    def test_errors(self):
+        text = self.create_text("<h1>One</h1><h3>Bad</h3>")
+        out = self.rerender()
+        self.assertTrue(out.startswith("3 processed, 2 changed, 1 errors"))
+        self.assertTrue(("  Text %d: " % text.pk) in out)
+        self.assertEqual("<h1>One</h1><h3>Bad</h3>", self.get_body(text))
+
+    def test_checkpoint(self):
+        checkpoint = os.path.join(self.tmpdir, 'checkpoint')
+        f = open(checkpoint, 'w')
+        f.write("%d\n" % self.texts[0].pk)
+        f.close()
+        out = self.rerender(checkpoint=checkpoint, chunk_size=1)
+        self.assertTrue(out.startswith("Resuming after id %d\n1 processed, 1 changed" % self.texts[0].pk))
+        self.assertTrue('class="old"' in self.get_body(self.texts[0]))
+        self.assertTrue('class="old"' not in self.get_body(self.texts[1]))
+        # Finishing removes the checkpoint, so the next run starts again
+        self.assertFalse(os.path.exists(checkpoint))
+        self.assertTrue(self.rerender(checkpoint=checkpoint).startswith("2 processed, 1 changed"))
+
+
+class TestBenchmark(TestCase):
+
+    def test_generate_document(self):
+        for name, kwargs in benchmark.DOCUMENTS.items():
+            html, styleinfo = benchmark.generate_document(seed=1, **kwargs)
+            self.assertEqual((html, styleinfo), benchmark.generate_document(seed=1, **kwargs))
+            # Must be valid
+            format_html(html, styleinfo)
+        self.assertNotEqual(benchmark.generate_document(seed=1),
+                            benchmark.generate_document(seed=2))
+
+    def test_run_benchmarks(self):
+        results = benchmark.run_benchmarks(documents=['small'], repeat=1)
+        self.assertEqual(['small'], results['results'].keys())
+        self.assertEqual(sorted(benchmark.STAGES),
+                         sorted(results['results']['small']['stages'].keys()))
+
+    def test_find_regressions(self):
+        def make_results(t):
+            return dict(results=dict(small=dict(stages=dict(parse=dict(min=t, median=t)))))
+        self.assertEqual([], benchmark.find_regressions(make_results(1.1), make_results(1.0)))
+        self.assertEqual([('small', 'parse', 1.0, 1.3)],
+                         benchmark.find_regressions(make_results(1.3), make_results(1.0)))
+
+
+class TestInstrumentation(TestCase):
+
+    def test_callback(self):
+        records = []
+        def callback(stage, duration, size):
+            records.append((stage, duration, size))
+        add_timing_callback(callback)
+        try:
+            html = "<h1>Hello</h1><p>Test</p>"
+            format_html(html, {})
+        finally:
+            remove_timing_callback(callback)
+        stages = [r[0] for r in records]
+        self.assertEqual('format_html', stages[-1])
+        for stage in ['parse', 'clean', 'structure', 'layout', 'classes', 'serialize']:
+            self.assert_('format_html.' + stage in stages)
+        self.assertEqual(set([len(html)]), set(r[2] for r in records))
+        # Total includes stages
+        self.assert_(records[-1][1] >= sum(r[1] for r in records[:-1]) * 0.99)
+
+        format_html(html, {})
+        self.assertEqual(len(stages), len(records))
+
+    def test_collect_timings(self):
+        html = "<h1>Hello</h1><p>Test</p>"
+        with collect_timings() as timings:
+            preview_html(html, {})
+            extract_presentation(format_html(html, {}))
+            clean_html(html)
+        stages = [stage for stage, duration in timings.totals()]
+        for stage in ['format_html', 'preview_html', 'preview_html.preview',
+                      'extract_presentation', 'extract_presentation.parse',
+                      'clean_html', 'clean_html.clean']:
+            self.assert_(stage in stages, stage)
+        # format_html was called once - preview_html doesn't need it
+        self.assertEqual(1, len([r for r in timings.records if r[0] == 'format_html']))
+
+
 class TestRetrieveStyles(TestCase):
     fixtures = ['test_classes.json']
 
@@ -913,3 +1860,214 @@ class TestRetrieveStyles(TestCase):
         c2 = [c for c in classes if c.category is not None and c.category.name == 'Borders']
         assert len(c2) > 0 # Sanity
         self.assertEqual(c2, list(CssClass.objects.filter(category__name='Borders').order_by('verbose_name')))
+
+
+class TestCssClassRegistry(TestCase):
+    fixtures = ['test_classes.json']
+
+    def setUp(self):
+        # Database changes are rolled back between tests without signals
+        css_class_registry.invalidate()
+
+    def test_classes(self):
+        classes = css_class_registry.get_classes()
+        self.assertEqual([c.name for c in classes],
+                         [c.name for c in get_classes('cms_harness/example.html')])
+        self.assertEqual(set(c.name for c in classes),
+                         set(css_class_registry.get_class_dict().keys()))
+        c = CssClass.objects.filter(category__isnull=False)[0]
+        pc = css_class_registry.get_class_dict()[c.name]
+        self.assertEqual(c.category.name, pc.category)
+        self.assertEqual(c.allowed_elements.lower().split(' '), pc.allowed_elements)
+
+    def test_no_queries(self):
+        css_class_registry.get_classes()
+        with self.assertNumQueries(0):
+            css_class_registry.get_classes()
+            css_class_registry.get_class_dict()
+
+    def test_invalidation(self):
+        c = CssClass.objects.filter(category__isnull=False)[0]
+        self.assertEqual(None, css_class_registry.get_class_dict()[c.name].column_equiv)
+        c.column_equiv = 2
+        c.save()
+        self.assertEqual(2, css_class_registry.get_class_dict()[c.name].column_equiv)
+
+        category = c.category
+        category.name = "New name"
+        category.save()
+        self.assertEqual("New name", css_class_registry.get_class_dict()[c.name].category)
+
+        c.delete()
+        self.assert_(c.name not in css_class_registry.get_class_dict())
+
+    def test_invalidated_after_commit(self):
+        # Tests run in a transaction, like requests
+        c = CssClass.objects.all()[0]
+        c.save()
+        # Before the commit, another thread could load the old data
+        classes = css_class_registry.get_classes()
+        self.assertTrue(classes is css_class_registry.get_classes())
+        request_finished.send(sender=self.__class__)
+        self.assertTrue(classes is not css_class_registry.get_classes())
+        # Only once
+        classes = css_class_registry.get_classes()
+        request_finished.send(sender=self.__class__)
+        self.assertTrue(classes is css_class_registry.get_classes())
+
+    def test_memoize(self):
+        calls = []
+        def make():
+            calls.append(1)
+            return len(css_class_registry.get_classes())
+        last_modified = css_class_registry.last_modified()
+        self.assertEqual(css_class_registry.memoize('test', make),
+                         css_class_registry.memoize('test', make))
+        self.assertEqual(1, len(calls))
+        CssClass.objects.all()[0].delete()
+        css_class_registry.memoize('test', make)
+        self.assertEqual(2, len(calls))
+        self.assert_(css_class_registry.last_modified() >= last_modified)
+
+    def test_template_key(self):
+        c = CssClass.objects.all()[0]
+        c.templates = ['cms_harness/example2.html']
+        c.save()
+        self.assertEqual('cms_harness/example2.html',
+                         css_class_registry.get_template_key('cms_harness/example2.html'))
+        self.assertEqual(css_class_registry.get_template_key('x.html'),
+                         css_class_registry.get_template_key('y.html'))
+
+    def test_get_classes_many_templates(self):
+        # 2000 classes across 40 templates, some available in all templates.
+        CssClass.objects.all().delete()
+        templates = ["template%d.html" % i for i in range(40)]
+        CssClass.objects.bulk_create([
+                CssClass(name="class%d" % i, verbose_name="Class %04d" % i,
+                         templates=[] if i % 10 == 0 else templates[i % 40:i % 40 + 1 + i % 3])
+                for i in range(2000)])
+        css_class_registry.invalidate()
+
+        def old_get_classes(template):
+            classes = CssClass.objects.all().order_by('category__name', 'verbose_name')
+            return [c for c in classes if c.templates == [] or template in c.templates]
+
+        for template in templates[0:3] + ["unknown.html"]:
+            self.assertEqual(old_get_classes(template), get_classes(template))
+
+        old_time = best_time(lambda: [old_get_classes(t) for t in templates[0:5]])
+        with self.assertNumQueries(0):
+            new_time = best_time(lambda: [get_classes(t) for t in templates[0:5]])
+        self.assertTrue(new_time * 10 < old_time,
+                        "Took %.4fs with index, %.4fs without" % (new_time, old_time))
+
+    def test_shared_version(self):
+        with override_settings(SEMANTICEDITOR_FORMAT_CACHE='default'):
+            classes = css_class_registry.get_classes()
+            self.assert_(classes is css_class_registry.get_classes())
+            # Another process changing the version:
+            caching.get_shared_cache().incr('semanticeditor:cssclasses:version')
+            self.assert_(classes is not css_class_registry.get_classes())
+
+
+class TestPageTemplateRegistry(TestCase):
+
+    def setUp(self):
+        self.templates = {1: 'a.html', 2: 'b.html'}
+        self.loads = []
+        registry = PageTemplateRegistry()
+        def load(page_id):
+            self.loads.append(page_id)
+            return self.templates[page_id]
+        registry._load = load
+        self.registry = registry
+
+    def test_cached(self):
+        self.assertEqual('a.html', self.registry.get_template(1))
+        self.assertEqual('a.html', self.registry.get_template("1"))
+        self.assertEqual('b.html', self.registry.get_template(2))
+        self.assertEqual([1, 2], self.loads)
+
+    def test_invalidate(self):
+        self.registry.get_template(1)
+        self.templates[1] = 'c.html'
+        self.registry.invalidate()
+        self.assertEqual('c.html', self.registry.get_template(1))
+
+    def test_shared_version(self):
+        with override_settings(SEMANTICEDITOR_FORMAT_CACHE='default'):
+            self.registry.get_template(1)
+            # Another process invalidating:
+            PageTemplateRegistry().invalidate()
+            self.registry.get_template(1)
+            self.assertEqual([1, 1], self.loads)
+
+    @needs_cms
+    def test_page_changes_invalidate(self):
+        # The handlers are connected in models.py, so they work in processes
+        # that don't import the views.
+        from cms.models import Page
+        from cms.signals import page_moved
+        from django.dispatch.dispatcher import _make_id
+        from semanticeditor.models import _pages_changed
+        for signal in (post_save, post_delete, page_moved):
+            self.assertTrue(_pages_changed in signal._live_receivers(_make_id(Page)))
+
+
+@scaling_test
+class TestScaling(TestCase):
+    """
+    Checks that the time taken by various operations grows linearly with the
+    size of the document.
+    """
+    def assertLinear(self, func, make_input, size=250, factor=4):
+        small = self.best_time(func, make_input, size)
+        large = self.best_time(func, make_input, size * factor)
+        # Allow plenty of margin for noise - quadratic behaviour would give a
+        # ratio of factor ** 2
+        self.assertTrue(large < small * factor * 2,
+                        "Took %.3fs for size %d, %.3fs for size %d" %
+                        (small, size, large, size * factor))
+
+    def best_time(self, func, make_input, size):
+        # Many of the functions change their input (e.g. clean_tree), so
+        # each run needs new input.
+        times = []
+        for i in range(3):
+            arg = make_input(size)
+            start = time.time()
+            func(arg)
+            times.append(time.time() - start)
+        return min(times)
+
+    def test_get_structure(self):
+        def make_input(n):
+            html = "".join('<h1 id="h1_%(i)d">Heading</h1><p id="p_%(i)d">Para</p>'
+                           '<blockquote id="blockquote_%(i)d"><p id="p_q%(i)d">Quote</p></blockquote>'
+                           '<ul id="ul_%(i)d"><li id="li_%(i)d">Item</li></ul>' % dict(i=i)
+                           for i in range(n))
+            return parse(html)
+        self.assertLinear(get_structure, make_input)
+
+    def test_sect_id_allocation(self):
+        # 10,000 paragraphs without ids, so every one has to be allocated.
+        def make_input(n):
+            return parse("<p>Para</p>" * n)
+        self.assertLinear(get_structure, make_input, size=1000, factor=10)
+
+    def test_clean_tree_ids(self):
+        # Thousands of distinct ids, with some duplicates
+        def make_input(n):
+            return parse("".join('<p id="p_%d">Para</p><p id="p_%d">Dup</p>' % (i, i // 2)
+                                 for i in range(n)))
+        self.assertLinear(clean_tree, make_input, size=2000)
+
+    def test_clean_tree_spans(self):
+        def make_input(n):
+            return parse("<p>" + "<span>Some <span>text</span></span> " * n + "</p>")
+        self.assertLinear(clean_tree, make_input, size=2000)
+
+    def test_clean_tree_nested_paragraphs(self):
+        def make_input(n):
+            return parse("<p>" + "<p>Some <b><p>text</p></b></p> " * n + "</p>")
+        self.assertLinear(clean_tree, make_input, size=1000)
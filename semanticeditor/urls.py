@@ -12,4 +12,5 @@ urlpatterns = patterns('',
     url(r'combine_presentation/', combine_presentation, name="semantic.combine_presentation"),
     url(r'clean_html/', clean_html_view, name="semantic.clean_html"),
     url(r'preview/', preview, name="semantic.preview"),
+    url(r'bootstrap/', bootstrap, name="semantic.bootstrap"),
 )
@@ -31,6 +31,10 @@ I can sing
 
 """
 
+from collections import OrderedDict
+import threading
+import time
+
 from semanticeditor.utils.mixins import StandardReprMixin
 
 
@@ -103,6 +107,81 @@ def struct(name, bases, attrdict):
 # using the __init__ functionality provided by the 'struct' type.
 
 
+class LRUCache(object):
+    """
+    A cache holding at most 'maxsize' items, which discards the least recently
+    used item when it is full.  If 'ttl' is given, items that have not been
+    used for that many seconds are also discarded.  Hits and misses are
+    counted.  It can be shared between threads.
+
+    >>> c = LRUCache(2)
+    >>> c.set('a', 1)
+    >>> c.set('b', 2)
+    >>> c.get('a')
+    1
+    >>> c.set('c', 3)
+    >>> c.get('b') is None
+    True
+    >>> (c.hits, c.misses)
+    (1, 1)
+    """
+    def __init__(self, maxsize, ttl=None, timer=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._timer = timer
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, used = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            now = self._now()
+            if self.ttl is not None and now - used > self.ttl:
+                self.misses += 1
+                return default
+            # Re-insert, to mark as most recently used.
+            self._data[key] = (value, now)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            now = self._now()
+            self._data[key] = (value, now)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            if self.ttl is not None:
+                # Items are in order of last use, so expired ones are first.
+                while self._data:
+                    oldest = next(iter(self._data))
+                    if now - self._data[oldest][1] <= self.ttl:
+                        break
+                    del self._data[oldest]
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def _now(self):
+        if self.ttl is None:
+            return None
+        return self._timer()
+
+    def __len__(self):
+        return len(self._data)
+
+
 def _test():
     import doctest
     doctest.testmod()
@@ -1,6 +1,7 @@
 """
 etree/ElementTree utils
 """
+from collections import deque
 
 # ElementTree utilities.  Lots of these are pinched
 # from proposed 'ElementLib' module on effbot.
@@ -44,12 +45,68 @@ def cleanup(elem, filter):
     elem[:] = out
 
 def flatten(elem):
-    text = elem.text or ""
-    for e in elem:
-        text += flatten(e)
-        if e.tail:
-            text += e.tail
-    return text
+    """
+    Returns all the text content of elem
+    """
+    return TextFlattener().flatten(elem)
+
+class TextFlattener(object):
+    """
+    Extracts the text content of elements, as flatten() does.
+
+    A limit can be passed to flatten(), in which case it stops collecting text
+    once that many characters have been found.  The complete text of elements
+    is remembered, so that flattening an element whose descendants have
+    already been flattened does not process them again.
+
+    The tree must not be modified while a TextFlattener is in use.
+    """
+    def __init__(self):
+        self._cache = {}
+
+    def flatten(self, elem, limit=None):
+        """
+        Returns the text content of elem.  If limit is given, the text may be
+        truncated, but it will be at least limit characters long if the
+        complete text is.
+        """
+        parts = []
+        self._flatten(elem, parts, [limit])
+        return "".join(parts)
+
+    def _flatten(self, elem, parts, remaining):
+        # Appends text to parts, and returns True if the complete text of elem
+        # was collected.  remaining is a single item list containing the
+        # number of characters still wanted, or None for no limit.
+        cached = self._cache.get(elem)
+        if cached is not None:
+            self._add(cached, parts, remaining)
+            return True
+
+        start = len(parts)
+        complete = True
+        if elem.text:
+            self._add(elem.text, parts, remaining)
+        for e in elem:
+            if remaining[0] is not None and remaining[0] <= 0:
+                complete = False
+                break
+            if not self._flatten(e, parts, remaining):
+                complete = False
+                break
+            if e.tail:
+                self._add(e.tail, parts, remaining)
+
+        if complete:
+            text = "".join(parts[start:])
+            parts[start:] = [text]
+            self._cache[elem] = text
+        return complete
+
+    def _add(self, text, parts, remaining):
+        parts.append(text)
+        if remaining[0] is not None:
+            remaining[0] -= len(text)
 
 def get_parent(topnode, elem):
     """
@@ -74,6 +131,22 @@ def get_depth(topnode, elem, _start=0):
             return d
     return None
 
+def iter_with_depth(elem):
+    """
+    Iterates over elem and all its descendants in document order, yielding
+    (node, depth) tuples, where depth is the same value get_depth(elem, node)
+    would return.  This is done in a single traversal, using an explicit stack
+    of pending nodes rather than searching from the top for every node.
+    """
+    stack = [(elem, 0)]
+    while stack:
+        node, depth = stack.pop()
+        yield node, depth
+        children = node.getchildren()
+        if children:
+            children.reverse()
+            stack.extend((c, depth + 1) for c in children)
+
 def get_index(parent, elem):
     """
     Return the index of elem in parent's children
@@ -102,38 +175,248 @@ def eliminate_tag(parent, index):
     Eliminates the tag from node at index 'index' from the parent.  The contents
     are pulled up into parent.
     """
-    elem = parent[index]
+    pull_up(parent[index])
+
 
-    first = index == 0
-    last = index == len(parent) - 1
+def pull_up(elem):
+    """
+    Eliminates the tag of elem, pulling its contents up into its parent, as
+    eliminate_tag does.  Only elem and its neighbours are looked at, so the
+    time taken does not depend on the number of siblings.
+    """
+    parent = elem.getparent()
+    prev = elem.getprevious()
+    children = elem.getchildren()
 
     # 'text'
-    if first:
+    if prev is None:
         # 'text' merges with parents.
         parent.text = textjoin(parent.text, elem.text)
     else:
         # 'text' merges with tail of previous sibling
-        prev = parent[index-1]
         prev.tail = textjoin(prev.tail, elem.text)
     # 'tail'
-    if len(elem.getchildren()) > 0:
+    if children:
         # tail always goes on last child's tail
-        elem[-1].tail = textjoin(elem[-1].tail, elem.tail)
+        children[-1].tail = textjoin(children[-1].tail, elem.tail)
     else:
-        if first:
+        next = elem.getnext()
+        if prev is None:
             # tail goes on parents text
             parent.text = textjoin(parent.text, elem.tail)
-        elif last: # (and not first)
-            prev = parent[index-1]
+        elif next is None:
             prev.tail = textjoin(prev.tail, elem.tail)
         else:
-            next = parent[index+1]
             next.text = textjoin(elem.tail, next.text)
+    elem.tail = None
 
-    # Replace element with its children
+    # Replace element with its children.  Moving a child takes its tail with
+    # it.
+    for c in children:
+        elem.addprevious(c)
     parent.remove(elem)
-    for c in reversed(elem.getchildren()):
-        parent.insert(index, c)
+
+
+def pull_up_all(elems):
+    """
+    Eliminates the tags of all the elements in elems, pulling their contents
+    up into their parents.  Elements may contain each other.  The result is
+    the same as calling pull_up for each element in turn, but the new
+    children and text of each parent are worked out first and set once, so
+    this is much faster than calling pull_up when there are many elements.
+    """
+    targets = set(elems)
+    # A model of the parts of the tree that change: linked lists of the
+    # children of the targets and their parents, and text and tails, which are
+    # None or a deque of strings (so that joining them is cheap).
+    parents = {}
+    prevs = {}
+    nexts = {}
+    firsts = {}
+    lasts = {}
+    texts = {}
+    tails = {}
+    changed = []
+
+    def add_parent(p):
+        if p in firsts:
+            return
+        prev = None
+        for c in p:
+            parents[c] = p
+            prevs[c] = prev
+            if prev is None:
+                firsts[p] = c
+            else:
+                nexts[prev] = c
+            prev = c
+        if prev is None:
+            firsts[p] = None
+        else:
+            nexts[prev] = None
+        lasts[p] = prev
+
+    def get(d, attr, n):
+        if n in d:
+            return d[n]
+        t = getattr(n, attr)
+        return None if t is None else deque([t])
+
+    def append(d, attr, n, t):
+        # As for n.attr = textjoin(n.attr, t)
+        value = get(d, attr, n)
+        if value is None:
+            value = deque()
+        if t is not None:
+            value.extend(t)
+        if n not in d:
+            changed.append(n)
+        d[n] = value
+
+    def prepend(d, attr, n, t):
+        # As for n.attr = textjoin(t, n.attr)
+        value = get(d, attr, n)
+        if value is None:
+            value = deque()
+        if t is not None:
+            value.extendleft(reversed(t))
+        if n not in d:
+            changed.append(n)
+        d[n] = value
+
+    for e in elems:
+        add_parent(e)
+        p = e.getparent()
+        if p is not None:
+            add_parent(p)
+
+    done = set()
+    for e in elems:
+        if e in done or e.getparent() is None:
+            continue
+        done.add(e)
+        # As for pull_up(e)
+        p, prev, next = parents[e], prevs[e], nexts[e]
+        first, last = firsts[e], lasts[e]
+        text, tail = get(texts, 'text', e), get(tails, 'tail', e)
+        if prev is None:
+            append(texts, 'text', p, text)
+        else:
+            append(tails, 'tail', prev, text)
+        if first is not None:
+            append(tails, 'tail', last, tail)
+        elif prev is None:
+            append(texts, 'text', p, tail)
+        elif next is None:
+            append(tails, 'tail', prev, tail)
+        else:
+            prepend(texts, 'text', next, tail)
+
+        # Replace e with its children in the list of p's children.
+        if first is None:
+            first, last = next, prev
+        else:
+            c = first
+            while c is not None:
+                parents[c] = p
+                c = nexts[c]
+            prevs[first] = prev
+            nexts[last] = next
+        if prev is None:
+            firsts[p] = first
+        else:
+            nexts[prev] = first
+        if next is None:
+            lasts[p] = last
+        else:
+            prevs[next] = last
+
+    # Moving an element takes its tail with it, so the children are moved
+    # before any text is set.
+    for p, c in firsts.items():
+        if p not in targets:
+            children = []
+            while c is not None:
+                children.append(c)
+                c = nexts[c]
+            p[:] = children
+    for n in changed:
+        if n not in targets:
+            if n in texts:
+                n.text = None if texts[n] is None else "".join(texts[n])
+            if n in tails:
+                n.tail = None if tails[n] is None else "".join(tails[n])
+
+
+class TreeIndex(object):
+    """
+    An index of the parent, index amongst siblings and depth of every node in
+    a tree, built in a single traversal.  This avoids the searches that
+    get_parent, get_index and get_depth have to do for every lookup.
+
+    The index is only valid as long as the tree is changed using the methods
+    of TreeIndex (which keep it up to date), and not by other means.
+    """
+    def __init__(self, topnode):
+        self.topnode = topnode
+        self._parents = {}
+        self._indexes = {}
+        self._depths = {}
+        # Parents whose children have moved since their indexes were recorded
+        self._stale = set()
+        for node, depth in iter_with_depth(topnode):
+            self._depths[node] = depth
+            for i, child in enumerate(node):
+                self._parents[child] = node
+                self._indexes[child] = i
+
+    def get_parent(self, elem):
+        """
+        Return the parent of 'elem', or None if it is the top node
+        """
+        return self._parents.get(elem)
+
+    def get_index(self, elem):
+        """
+        Return the index of elem in its parent's children
+        """
+        parent = self._parents[elem]
+        if parent in self._stale:
+            # Renumber all the children at once, rather than after every
+            # change.
+            self._stale.discard(parent)
+            for i, child in enumerate(parent):
+                self._indexes[child] = i
+        return self._indexes[elem]
+
+    def get_depth(self, elem):
+        """
+        Returns the depth of elem in the tree, 0 for the top node
+        """
+        return self._depths[elem]
+
+    def eliminate_tag(self, parent, index):
+        """
+        As for eliminate_tag, updating the index.
+        """
+        self.pull_up(parent[index])
+
+    def pull_up(self, elem):
+        """
+        As for pull_up, updating the index.
+        """
+        parent = self._parents[elem]
+        children = elem.getchildren()
+        pull_up(elem)
+
+        del self._parents[elem]
+        del self._indexes[elem]
+        del self._depths[elem]
+        self._stale.add(parent)
+        for child in children:
+            self._parents[child] = parent
+            for n in child.iter():
+                self._depths[n] -= 1
 
 
 def empty_text(txt):
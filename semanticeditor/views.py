@@ -1,11 +1,16 @@
-from cms.models import Page
 from django.http import HttpResponse
 from django.utils import simplejson
 from django.core.mail import mail_admins
 from django.conf import settings
 from django.utils.translation import ugettext as _
-from semanticeditor.api import extract_presentation, format_html, preview_html, AllUserErrors, COMMANDS, PresentationInfo, PresentationClass, clean_html, get_classes
-from semanticeditor.models import CssClass
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+from semanticeditor.api import extract_presentation, format_html_cached, preview_html, AllUserErrors, COMMANDS, clean_html, get_presentation_info
+from semanticeditor.instrumentation import collect_timings
+from semanticeditor.preview import get_preview_sessions, PreviewSessionExpired
+# css_class_to_presentation_class is imported for code that used it from here.
+from semanticeditor.registry import css_class_registry, css_class_to_presentation_class, page_template_registry
+import hashlib
 import sys
 try:
     from functools import wraps
@@ -42,8 +47,20 @@ def json_view(func):
     {'result': 'error',
      'message': an_error_message
     }
+
+    The function can also return an HttpResponse containing JSON that has
+    already been serialised.
     """
     def wrapper(request, *a, **kw):
+        if getattr(settings, 'SEMANTICEDITOR_SERVER_TIMING', False):
+            with collect_timings() as timings:
+                http_response = _wrapper(request, *a, **kw)
+            http_response['Server-Timing'] = server_timing_header(timings)
+            return http_response
+        else:
+            return _wrapper(request, *a, **kw)
+
+    def _wrapper(request, *a, **kw):
         response = None
         try:
             response = func(request, *a, **kw)
@@ -69,12 +86,27 @@ def json_view(func):
                 msg = _('Internal error')+': '+ str(e)
             response = error(msg)
 
+        if isinstance(response, HttpResponse):
+            # Already serialised
+            return response
         json = simplejson.dumps(response)
         return HttpResponse(json, mimetype='application/json')
 
     return wraps(func)(wrapper)
 
 
+def server_timing_header(timings):
+    """
+    Returns the value of a Server-Timing header for the total time spent in
+    each stage recorded by a TimingCollector, followed by the totals of any
+    counts (e.g. clean_tree.passes) as descriptions.
+    """
+    return ", ".join(["%s;dur=%.2f" % (stage, duration * 1000)
+                      for stage, duration in timings.totals()] +
+                     ['%s;desc="%s"' % (name, value)
+                      for name, value in timings.count_totals()])
+
+
 def error(msg):
     """
     Standard error result - for internal errors
@@ -121,7 +153,7 @@ def PI_to_dict(pi):
     # turned into JSON.
     allowed = set([str, unicode, int, bool, dict, list])
     for k, v in pi.__dict__.items():
-        if type(v) in allowed:
+        if type(v) in allowed and not k.startswith('_'):
             d[k] = v
     return d
 
@@ -129,44 +161,79 @@ def PI_to_dict(pi):
 def dict_to_PI(d, classes):
     """
     Convert a dictionary to a PresentationInfo,
-    using a pre-fetched dictionary of CssClass objects
+    using a pre-fetched dictionary of PresentationClass objects
     """
     if d['prestype'] == 'command':
-        return PresentationInfo(prestype=d['prestype'], name=d['name'])
+        return get_presentation_info(d['prestype'], d['name'])
     else:
-        c = classes.get(d['name'])
-        if c is None:
-            return None
-        else:
-            return css_class_to_presentation_class(c)
+        return classes.get(d['name'])
+
+
+def _get_template(request):
+    template = request.REQUEST['template']
+    if template == TEMPLATE_INHERITANCE_MAGIC:
+        # Need to look up page to find out what template to use
+        template = page_template_registry.get_template(request.REQUEST['page_id'])
+    return template
 
 
-def css_class_to_presentation_class(c):
-    return PresentationClass(c.name,
-                             verbose_name=c.verbose_name,
-                             description=c.description,
-                             allowed_elements=c.allowed_elements.lower().split(' '),
-                             column_equiv=c.column_equiv,
-                             category=c.category.name if c.category is not None else None)
+def _styles_json(template):
+    # Returns (etag, JSON) for the styles available in template
+    def make():
+        json = simplejson.dumps(success(map(PI_to_dict, css_class_registry.get_classes(template))))
+        return (hashlib.sha1(json).hexdigest(), json)
+    return css_class_registry.memoize(('retrieve_styles', css_class_registry.get_template_key(template)),
+                                      make)
 
 
+def _styles_list_json(template):
+    # Returns JSON for just the list of styles available in template
+    return css_class_registry.memoize(('styles', css_class_registry.get_template_key(template)),
+                                      lambda: simplejson.dumps(map(PI_to_dict, css_class_registry.get_classes(template))))
+
+
+def _styles_etag(request):
+    try:
+        return _styles_json(_get_template(request))[0]
+    except Exception:
+        # Let retrieve_styles report the error
+        return None
+
+
+def _styles_last_modified(request):
+    return css_class_registry.last_modified()
+
+
+def _revalidate(view):
+    # The responses below can be cached by the browser, but must be checked
+    # with the server each time, in case CSS classes have changed.
+    def wrapper(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        patch_cache_control(response, no_cache=True)
+        return response
+    return wraps(view)(wrapper)
+
+
+@_revalidate
+@condition(etag_func=_styles_etag, last_modified_func=_styles_last_modified)
 @json_view
 def retrieve_styles(request):
-    template = request.GET['template']
-    page_id = request.GET['page_id']
-    if template == TEMPLATE_INHERITANCE_MAGIC:
-        # Need to look up page to find out what template to use
-        p = Page.objects.get(pk=page_id)
-        template = p.get_template()
-    classes = get_classes(template)
-    retval = map(css_class_to_presentation_class,
-                 classes)
-    return success(map(PI_to_dict,retval))
+    return HttpResponse(_styles_json(_get_template(request))[1], mimetype='application/json')
 
 
-@json_view
+# Commands never change while the server is running
+_COMMANDS_LIST_JSON = simplejson.dumps(map(PI_to_dict, COMMANDS))
+_COMMANDS_JSON = simplejson.dumps(success(map(PI_to_dict, COMMANDS)))
+# The ETag is derived from the content, so it is the same in every process.
+# There is no Last-Modified, as the only time available would be when each
+# process started.
+_COMMANDS_ETAG = hashlib.sha1(_COMMANDS_JSON).hexdigest()
+
+
+@_revalidate
+@condition(etag_func=lambda request: _COMMANDS_ETAG)
 def retrieve_commands(request):
-    return success(map(PI_to_dict, COMMANDS))
+    return HttpResponse(_COMMANDS_JSON, mimetype='application/json')
 
 
 @json_view
@@ -175,27 +242,50 @@ def separate_presentation(request):
     Returns a JSON object:
      { presentation: <dictionary of presentation info from html>
        html: <input html stripped of presentation>
+       fingerprint: <value to send back to combine_presentation>
      }
     """
     data = request.POST.get('html','')
+    return graceful_errors(AllUserErrors, lambda: _separate_presentation(data))
+
+
+def _separate_presentation(data):
+    pres, html, fingerprint = extract_presentation(data, return_fingerprint=True)
+    # Rewrite pres so that we can serialise it to JSON
+    pres2 = {}
+    for k, v in pres.items():
+        pres2[k] = [PI_to_dict(p) for p in v]
+    return dict(presentation=pres2,
+                html=html,
+                fingerprint=fingerprint)
 
-    def _handled():
-        pres, html = extract_presentation(data)
-        # Rewrite pres so that we can serialise it to JSON
-        pres2 = {}
-        for k, v in pres.items():
-            pres2[k] = [PI_to_dict(p) for p in v]
-        return dict(presentation=pres2,
-                    html=html)
 
-    return graceful_errors(AllUserErrors, _handled)
+@json_view
+def bootstrap(request):
+    """
+    Returns everything the editor needs to start, in one request. Takes
+    'template', 'page_id' and 'html' parameters, and returns a JSON object:
+     { commands: <as for retrieve_commands>
+       styles: <as for retrieve_styles>
+       separated: <the complete response from separate_presentation>
+     }
+    """
+    # Commands and styles are already serialised, so the response is put
+    # together as a string.
+    separated = graceful_errors(AllUserErrors,
+                                lambda: _separate_presentation(request.POST.get('html', '')))
+    json = ('{"result": "ok", "value": {"commands": %s, "styles": %s, "separated": %s}}' %
+            (_COMMANDS_LIST_JSON,
+             _styles_list_json(_get_template(request)),
+             simplejson.dumps(separated)))
+    return HttpResponse(json, mimetype='application/json')
 
 
 def _convert_pres(pres):
-    # Convert dictionaries into PresentationInfo classes. We need actual
-    # CssClass instances in order to be able to restore column_equiv and
-    # allowed_elements info
-    classes = dict((c.name, c) for c in CssClass.objects.all())
+    # Convert dictionaries into PresentationInfo classes. We need the
+    # CssClass data in order to be able to restore column_equiv and
+    # allowed_elements info.
+    classes = css_class_registry.get_class_dict()
     retval = {}
     for k, v in pres.items():
         # v is list of PI dicts
@@ -214,16 +304,42 @@ def combine_presentation(request):
     """
     Combines submitted 'html' and 'presentation' data,
     returning a dictionary containing { html: <combined html> }
+
+    If the optional 'fingerprint' returned by separate_presentation is sent,
+    and the data is unchanged, the original HTML is returned.
     """
     html = request.POST.get('html', '')
     presentation = request.POST.get('presentation', '{}')
     presentation = simplejson.loads(presentation)
-    presentation = _convert_pres(presentation)
-    return graceful_errors(AllUserErrors, lambda: dict(html=format_html(html, presentation, pretty_print=True)))
+    fingerprint = request.POST.get('fingerprint') or None
+    return graceful_errors(AllUserErrors, lambda: dict(html=combine(html, presentation, fingerprint)))
+
+
+def combine(html, presentation, fingerprint=None):
+    """
+    Combines content HTML with presentation info in the form sent by the
+    client (dictionaries as produced by PI_to_dict), returning the formatted
+    HTML.  Raises AllUserErrors if the HTML can't be formatted.
+    """
+    return format_html_cached(html, _convert_pres(presentation), pretty_print=True,
+                              fingerprint=fingerprint)
 
 
 @json_view
 def preview(request):
+    """
+    Returns a preview of submitted 'html' and 'presentation' data, as
+    { html: <preview html> }
+
+    If 'blocks' is sent instead of 'html', an incremental preview is returned
+    for the editing session - see semanticeditor.preview.  The client sends
+    'session' and 'revision' from the previous response (if any), 'blocks'
+    and changes to 'presentation', and the response is
+    { session: <id>, revision: <revision>, fragments: <list> }
+    or { expired: true } if the client must start again.
+    """
+    if 'blocks' in request.POST:
+        return _incremental_preview(request)
     html = request.POST.get('html', '')
     presentation = request.POST.get('presentation', '{}')
     presentation = simplejson.loads(presentation)
@@ -232,6 +348,51 @@ def preview(request):
     return graceful_errors(AllUserErrors, lambda: dict(html=preview_html(html, presentation)))
 
 
+def _incremental_preview(request):
+    sessions = get_preview_sessions()
+    try:
+        session_id = request.POST.get('session')
+        try:
+            revision = int(request.POST.get('revision', 0)) if session_id else 0
+            blocks = simplejson.loads(request.POST['blocks'])
+            presentation = simplejson.loads(request.POST.get('presentation', '{}'))
+        except ValueError:
+            return failure(_("Invalid preview request"))
+        if not (_valid_blocks(blocks) and _valid_presentation_changes(presentation)):
+            return failure(_("Invalid preview request"))
+        if session_id:
+            session = sessions.get(session_id)
+        else:
+            session = sessions.create()
+
+        def _handled():
+            fragments = session.update(revision, blocks, presentation, _convert_pres)
+            return dict(session=session.id,
+                        revision=revision + 1,
+                        fragments=fragments)
+
+        return graceful_errors(AllUserErrors, _handled)
+    except PreviewSessionExpired:
+        return success(dict(expired=True))
+
+
+def _valid_blocks(blocks):
+    # Each block is HTML, or the index of a block sent previously.
+    return (isinstance(blocks, list) and
+            all(isinstance(b, basestring) or
+                (isinstance(b, (int, long)) and not isinstance(b, bool))
+                for b in blocks))
+
+
+def _valid_presentation_changes(presentation):
+    # section id: list of presentation info dictionaries, or None
+    return (isinstance(presentation, dict) and
+            all(v is None or
+                (isinstance(v, list) and
+                 all(isinstance(d, dict) and 'prestype' in d and 'name' in d for d in v))
+                for v in presentation.values()))
+
+
 @json_view
 def clean_html_view(request):
     html = request.POST.get('html', '')
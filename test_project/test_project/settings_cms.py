@@ -0,0 +1,26 @@
+from django.conf import global_settings
+
+from .settings import *
+
+# Settings for also running the tests that need django CMS (the views, the
+# plugin and the management commands):
+#
+#   ./manage.py test semanticeditor --settings=test_project.settings_cms
+
+TEMPLATE_CONTEXT_PROCESSORS = global_settings.TEMPLATE_CONTEXT_PROCESSORS + (
+    'django.core.context_processors.request',
+    'cms.context_processors.media',
+    'sekizai.context_processors.sekizai',
+)
+
+INSTALLED_APPS = INSTALLED_APPS + (
+    'cms',
+    'cms.plugins.text',
+    'mptt',
+    'menus',
+    'sekizai',
+)
+
+ROOT_URLCONF = 'test_project.urls_cms'
+
+SEMANTICEDITOR_MEDIA_URL = STATIC_URL + "semanticeditor/"